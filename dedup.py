@@ -0,0 +1,312 @@
+"""
+near-duplicate removal for Donut datasets, as written by mageXML's create_dataset and genara's run.py: split folders
+with images and a metadata.jsonl each
+
+every sample gets a perceptual hash (pHash, checked with a dHash) of its image and a hash of its normalized ground
+truth. near-duplicate images are found with a multi-index lookup: a 64 bit hash is cut into max_distance + 1
+bands, so two hashes at most max_distance bits apart agree exactly on at least one band. sorting on each band puts
+the candidates next to each other, which scales to tens of millions of samples without comparing every pair.
+duplicates are grouped with union-find, then dropped or down-weighted
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import unicodedata
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+SPLITS = ["train", "validation", "test"]
+
+## pHash: the 8x8 lowest frequencies of the DCT of a 32x32 grayscale thumbnail
+_DCT = np.cos(np.pi * np.outer(np.arange(32), 2 * np.arange(32) + 1) / 64)
+
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    """
+    set bits of every uint64, with the usual SWAR bit tricks so it stays vectorized
+    """
+
+    x = x.astype(np.uint64)
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def _bits(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def image_hashes(path: str) -> tuple:
+    """
+    (pHash, dHash) of an image, both 64 bit. jpegs are decoded at reduced size, the hashes only need a thumbnail
+    """
+
+    with Image.open(path) as im:
+        im.draft("L", (64, 64))
+        im = im.convert("L")
+        d = np.asarray(im.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+        p = np.asarray(im.resize((32, 32), Image.BILINEAR), dtype=np.float64)
+
+    dhash = _bits(d[:, 1:] > d[:, :-1])
+    low = (_DCT @ p @ _DCT.T)[:8, :8].flatten()
+    ## the DC term is left out of the median, it only carries the mean brightness
+    phash = _bits(low > np.median(low[1:]))
+    return phash, dhash
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def text_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(normalize_text(text).encode(), digest_size=8).digest(), "big")
+
+
+def load_samples(dataset: str) -> list:
+    """
+    (split, file_name, ground truth, metadata line) of every sample of the split folders of a dataset
+    """
+
+    samples = []
+    for split in SPLITS:
+        path = os.path.join(dataset, split, "metadata.jsonl")
+        if not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                d = json.loads(line)
+                gt = json.loads(d["ground_truth"])["gt_parse"].get("text_sequence", "")
+                samples.append((split, d["file_name"], gt, line))
+    return samples
+
+
+def near_pairs(hashes: np.ndarray, max_distance=4, window=64, tie=None) -> np.ndarray:
+    """
+    (i, j) pairs of hashes at most max_distance bits apart, by multi-index hashing over max_distance + 1 bands
+
+    each band is sorted and only neighbours up to window apart in the sorted order are compared, so a band
+    value shared by a huge number of samples does not blow up quadratically. with tie as second sort key,
+    samples with the same tie value are adjacent within a band, e.g. the same ground truth
+    """
+
+    n_bands = max_distance + 1
+    width = 64 // n_bands
+    hashes = hashes.astype(np.uint64)
+    tie = hashes if tie is None else tie
+
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    for b in range(n_bands):
+        shift = b * width
+        bits = width if b < n_bands - 1 else 64 - shift
+        key = (hashes >> np.uint64(shift)) & np.uint64((1 << bits) - 1)
+        order = np.lexsort((tie, key))
+        sorted_key = key[order]
+        for k in range(1, window + 1):
+            same = sorted_key[k:] == sorted_key[:-k]
+            if not same.any():
+                break
+            i, j = order[:-k][same], order[k:][same]
+            close = popcount(hashes[i] ^ hashes[j]) <= max_distance
+            pairs.append(np.stack([i[close], j[close]], axis=1))
+
+    pairs = np.concatenate(pairs)
+    return np.unique(np.sort(pairs, axis=1), axis=0)
+
+
+def equal_pairs(values: np.ndarray) -> np.ndarray:
+    """
+    (i, j) pairs chaining together all samples with the same value
+    """
+
+    order = np.argsort(values, kind="stable")
+    same = values[order][1:] == values[order][:-1]
+    return np.stack([order[:-1][same], order[1:][same]], axis=1)
+
+
+def union_find(n: int, pairs) -> np.ndarray:
+    """
+    group of every sample, the smallest sample index of its connected component
+    """
+
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for pair in pairs:
+        for i, j in pair.tolist():
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                if ri < rj:
+                    parent[rj] = ri
+                else:
+                    parent[ri] = rj
+    return np.array([find(x) for x in range(n)], dtype=np.int64)
+
+
+def duplicate_groups(phashes: np.ndarray, dhashes: np.ndarray, text_hashes: np.ndarray, mode="both",
+                     max_distance=4, window=64) -> np.ndarray:
+    """
+    group of every sample, samples of the same group are duplicates of each other
+
+    image: near-duplicate images, pHash and dHash both within max_distance bits
+    text: the same normalized ground truth
+    both: near-duplicate images with the same normalized ground truth (re-scans of a page)
+    either: any of the two (also catches the same short line rendered again)
+    """
+
+    pairs = []
+    if mode in ("text", "either"):
+        pairs.append(equal_pairs(text_hashes))
+    if mode in ("image", "both", "either"):
+        image_pairs = near_pairs(phashes, max_distance, window, text_hashes if mode == "both" else None)
+        i, j = image_pairs[:, 0], image_pairs[:, 1]
+        keep = popcount(dhashes[i] ^ dhashes[j]) <= max_distance
+        if mode == "both":
+            keep &= text_hashes[i] == text_hashes[j]
+        pairs.append(image_pairs[keep])
+    return union_find(len(phashes), pairs)
+
+
+def _hash_sample(path: str) -> tuple:
+    try:
+        return image_hashes(path)
+    except Exception:
+        ## unreadable images never match anything
+        return None
+
+
+def hash_dataset(dataset: str, samples: list, processes=None) -> tuple:
+    """
+    pHash, dHash and ground truth hash arrays of the samples, the images are hashed over a process pool
+    """
+
+    paths = [os.path.join(dataset, split, file_name) for split, file_name, _, _ in samples]
+    phashes = np.zeros(len(samples), dtype=np.uint64)
+    dhashes = np.zeros(len(samples), dtype=np.uint64)
+    valid = np.ones(len(samples), dtype=bool)
+    with Pool(processes) as pool:
+        for idx, hashes in enumerate(pool.imap(_hash_sample, paths, chunksize=256)):
+            if hashes is None:
+                valid[idx] = False
+                ## unique garbage, far from every other hash
+                phashes[idx] = dhashes[idx] = np.uint64(hash(paths[idx]) & (2 ** 64 - 1))
+            else:
+                phashes[idx], dhashes[idx] = hashes
+    text_hashes = np.array([text_hash(gt) for _, _, gt, _ in samples], dtype=np.uint64)
+    return phashes, dhashes, text_hashes, valid
+
+
+def report(samples: list, groups: np.ndarray, largest=10) -> dict:
+    split_of = np.array([split for split, _, _, _ in samples])
+    keep = groups == np.arange(len(groups))
+    sizes = np.bincount(groups, minlength=len(groups))
+
+    per_split = {}
+    for split in SPLITS:
+        in_split = split_of == split
+        if in_split.any():
+            per_split[split] = {"samples": int(in_split.sum()), "duplicates": int((in_split & ~keep).sum())}
+
+    ## groups with members in more than one split leak between train and evaluation
+    cross_split = 0
+    members = {}
+    for idx in np.flatnonzero(sizes[groups] > 1):
+        members.setdefault(int(groups[idx]), []).append(int(idx))
+    for g, idx in members.items():
+        if len(set(split_of[idx])) > 1:
+            cross_split += 1
+
+    biggest = sorted(members.items(), key=lambda kv: -len(kv[1]))[:largest]
+    return {
+        "samples": len(samples),
+        "kept": int(keep.sum()),
+        "duplicates": int((~keep).sum()),
+        "removed_fraction": float((~keep).sum() / len(samples)) if samples else 0.0,
+        "duplicate_groups": len(members),
+        "cross_split_groups": cross_split,
+        "splits": per_split,
+        "largest_groups": [
+            {
+                "size": len(idx),
+                "ground_truth": samples[idx[0]][2],
+                "file_names": [f"{samples[i][0]}/{samples[i][1]}" for i in idx[:10]],
+            }
+            for _, idx in biggest
+        ],
+    }
+
+
+def rewrite_metadata(dataset: str, samples: list, groups: np.ndarray, action: str) -> None:
+    """
+    drop: keep only the first sample of every group in metadata.jsonl, the images stay on disk
+    weight: keep every sample, with a weight of 1 / group size added to its metadata row
+
+    the original metadata.jsonl of every split is kept as metadata.jsonl.orig
+    """
+
+    sizes = np.bincount(groups, minlength=len(groups))
+    lines = {split: [] for split in SPLITS}
+    for idx, (split, _, _, line) in enumerate(samples):
+        if action == "drop":
+            if groups[idx] == idx:
+                lines[split].append(line)
+        else:
+            row = json.loads(line)
+            row["weight"] = 1 / int(sizes[groups[idx]])
+            lines[split].append(json.dumps(row, ensure_ascii=False) + "\n")
+
+    for split, split_lines in lines.items():
+        path = os.path.join(dataset, split, "metadata.jsonl")
+        if not os.path.exists(path):
+            continue
+        if not os.path.exists(path + ".orig"):
+            shutil.copyfile(path, path + ".orig")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.writelines(split_lines)
+        os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="find and remove near-duplicate samples of a Donut dataset")
+    parser.add_argument("dataset", type=str) ## folder with train, validation and test folders
+    parser.add_argument("--mode", type=str, default="both", choices=["image", "text", "both", "either"])
+    parser.add_argument("--max_distance", type=int, default=4) ## bits two image hashes may differ by
+    parser.add_argument("--window", type=int, default=64) ## neighbours compared per sample and band
+    parser.add_argument("--action", type=str, default="report", choices=["report", "drop", "weight"])
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--save_path", type=str, default=None) ## json report
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    samples = load_samples(args.dataset)
+    phashes, dhashes, text_hashes, valid = hash_dataset(args.dataset, samples, args.processes)
+    hashed = time.perf_counter()
+    groups = duplicate_groups(phashes, dhashes, text_hashes, args.mode, args.max_distance, args.window)
+
+    result = report(samples, groups)
+    result.update(
+        mode=args.mode,
+        unreadable=int((~valid).sum()),
+        hash_seconds=hashed - start,
+        group_seconds=time.perf_counter() - hashed,
+    )
+    print(f"{result['duplicates']} of {result['samples']} samples are duplicates ({result['removed_fraction']:.1%}), "
+          f"{result['duplicate_groups']} groups, {result['cross_split_groups']} across splits")
+
+    if args.action != "report":
+        rewrite_metadata(args.dataset, samples, groups, args.action)
+
+    if args.save_path:
+        with open(args.save_path, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
@@ -1,17 +1,17 @@
-from torchmetrics.text import CharErrorRate
-import json
+import argparse
 
-## change this line to the path to the json result of the test by Donut
-f = open('donut/result/pthw2.json', 'r')
+from cer import evaluate, iter_pairs, load_references
 
-res = json.load(f)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="character error rate of a Donut test result, see cer.py for the full report")
+    ## the json result of the test by Donut, a JSONL results file or a manifest .parquet with predictions and ground truth
+    parser.add_argument("results_path", type=str, nargs="?", default="donut/result/pthw2.json")
+    parser.add_argument("--dataset", type=str, default=None) ## dataset folder or manifest with the ground truth, needed for JSONL results
+    args = parser.parse_args()
 
-# print(res['ground_truths'])
+    references = load_references(args.dataset) if args.dataset else None
+    report = evaluate(iter_pairs(args.results_path, references))
 
+    # print(report['length_buckets'])
 
-
-preds = [ t['text_sequence'] for t in res['predictions']]
-target = [t['text_sequence'] for t in res['ground_truths']]
-
-cer = CharErrorRate()
-print(cer(preds, target))
+    print(report['corpus']['cer'])
@@ -0,0 +1,118 @@
+import hashlib
+import os
+
+import torch
+
+from donut import DonutModel
+from donut.model import SwinEncoder
+
+from prediction_cache import model_identity
+
+BACKENDS = ["torch", "int8", "onnx"]
+
+
+class OnnxEncoder(torch.nn.Module):
+    """
+    drop-in replacement for Donut's SwinEncoder that runs the exported encoder under onnxruntime on CPU.
+    preprocessing is SwinEncoder's own prepare_input, the torch encoder weights are not kept
+    """
+
+    prepare_input = SwinEncoder.prepare_input
+
+    def __init__(self, encoder: SwinEncoder, onnx_path: str, identity: str = None):
+        super().__init__()
+        self.input_size = encoder.input_size
+        self.align_long_axis = encoder.align_long_axis
+        self.to_tensor = encoder.to_tensor
+        self.onnx_path = onnx_path
+        self._session = None
+        self._pid = None
+
+        ## the identity of the checkpoint it was exported from is kept next to the file, a retrained or different
+        ## checkpoint is exported again instead of silently running a stale encoder
+        identity_path = onnx_path + ".identity"
+        exported = None
+        if os.path.exists(onnx_path) and os.path.exists(identity_path):
+            with open(identity_path) as f:
+                exported = f.read()
+        if exported is None or (identity is not None and exported != identity):
+            export_encoder(encoder, onnx_path)
+            with open(identity_path, "w") as f:
+                f.write(identity or "")
+
+    @property
+    def session(self):
+        ## onnxruntime sessions are not fork safe, every process makes its own
+        if self._session is None or self._pid != os.getpid():
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            self._session = onnxruntime.InferenceSession(self.onnx_path, options, providers=["CPUExecutionProvider"])
+            self._pid = os.getpid()
+        return self._session
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = self.session.run(None, {"pixel_values": x.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(out)
+
+
+def export_encoder(encoder: SwinEncoder, onnx_path: str) -> None:
+    """
+    export the encoder to onnx with a dynamic batch dimension
+    """
+
+    dirname = os.path.dirname(onnx_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    dummy = torch.zeros(1, 3, *encoder.input_size)
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder.float().cpu(),
+            dummy,
+            onnx_path,
+            input_names=["pixel_values"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "last_hidden_state": {0: "batch"}},
+            opset_version=14,
+        )
+
+
+def onnx_cache_dir() -> str:
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "donut_utils", "onnx")
+
+
+def load_model(pretrained_model_name_or_path: str, backend="torch", onnx_path=None) -> DonutModel:
+    """
+    Donut model for inference with the given backend
+
+    torch: the full precision model, in half precision on CUDA when available (the original path)
+    int8: dynamic int8 quantization of every Linear layer of the encoder and decoder, CPU only
+    onnx: the encoder exported to onnx (once per checkpoint, to onnx_path) and run under onnxruntime, the
+          autoregressive decoder stays in full precision torch. CPU only. onnx_path defaults to a file named after
+          the checkpoint's model_identity under onnx_cache_dir(), never inside the checkpoint folder: a file
+          written there would change its model_identity and with it the prediction cache of the torch backend
+    """
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, should be one of {BACKENDS}")
+
+    model = DonutModel.from_pretrained(pretrained_model_name_or_path)
+    model.eval()
+
+    if backend == "torch":
+        if torch.cuda.is_available():
+            model.half()
+            model.to("cuda")
+        return model
+
+    if backend == "int8":
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    identity = model_identity(pretrained_model_name_or_path)
+    if onnx_path is None:
+        name = hashlib.sha256(identity.encode()).hexdigest()[:32]
+        onnx_path = os.path.join(onnx_cache_dir(), name, "encoder.onnx")
+    model.encoder = OnnxEncoder(model.encoder, onnx_path, identity)
+    return model
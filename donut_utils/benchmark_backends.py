@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import time
+
+## numpy, torch, torchmetrics and everything that imports them are only imported once they are needed, so --help
+## does not pay for them
+from inferencing import ImageFolderDataset, collate, run_batch
+
+
+def cer(preds: list, target: list):
+    from torchmetrics.text import CharErrorRate
+
+    return float(CharErrorRate()(preds, target)) if target else None
+
+
+def benchmark(args, backend: str) -> dict:
+    """
+    latency, throughput and predictions of one backend on the first args.limit images of the folder
+    """
+
+    import numpy as np
+    import torch
+    from torch.utils.data import DataLoader
+
+    from backends import load_model
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    load_start = time.perf_counter()
+    model = load_model(args.pretrained_model_name_or_path, backend, args.onnx_path)
+    load_seconds = time.perf_counter() - load_start
+
+    dataset = ImageFolderDataset(args.dataset_name_or_path, model.encoder.prepare_input)
+    dataset.file_names = dataset.file_names[:args.limit]
+    loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=collate)
+
+    prompt_tensors = model.decoder.tokenizer(
+        f"<s_{args.task_name}>", add_special_tokens=False, return_tensors="pt"
+    )["input_ids"]
+
+    predictions = {}
+    latencies = []
+    with torch.no_grad():
+        ## untimed warm up batch, e.g. for the onnxruntime session
+        image_tensors, _, _, _, cached, _ = collate([dataset[i] for i in range(min(args.batch_size, len(dataset)))])
+        run_batch(model, image_tensors, prompt_tensors, cached)
+
+        start = time.perf_counter()
+        for image_tensors, file_names, _, _, cached, _ in loader:
+            batch_start = time.perf_counter()
+            outputs, _ = run_batch(model, image_tensors, prompt_tensors, cached)
+            latencies.append((time.perf_counter() - batch_start) / len(file_names))
+            for output, file_name in zip(outputs, file_names):
+                predictions[file_name] = output.get("text_sequence", "")
+        seconds = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "backend": backend,
+        "images": len(predictions),
+        "load_seconds": load_seconds,
+        "seconds": seconds,
+        "images_per_sec": len(predictions) / seconds,
+        "latency_ms_per_image": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+        },
+        "predictions": predictions,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare inference backends on latency, throughput and CER")
+    parser.add_argument("--pretrained_model_name_or_path", type=str)
+    parser.add_argument("--dataset_name_or_path", type=str) ## folder of images, with a metadata.jsonl for the CER against ground truth
+    parser.add_argument("--task_name", type=str, default=None)
+    parser.add_argument("--backends", type=str, default=None) ## comma separated, defaults to every backend of backends.py
+    parser.add_argument("--onnx_path", type=str, default=None)
+    parser.add_argument("--limit", type=int, default=200) ## number of images per backend
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--save_path", type=str, default="backends.json")
+    args, left_argv = parser.parse_known_args()
+
+    from bucketing import load_ground_truths
+
+    if args.backends is None:
+        from backends import BACKENDS
+
+        args.backends = ",".join(BACKENDS)
+    if args.task_name is None:
+        args.task_name = os.path.basename(args.dataset_name_or_path)
+
+    ground_truths = load_ground_truths(args.dataset_name_or_path)
+
+    runs = [benchmark(args, backend) for backend in args.backends.split(",")]
+    reference = runs[0]["predictions"]
+
+    for run in runs:
+        predictions = run.pop("predictions")
+        with_gt = [f for f in predictions if f in ground_truths]
+        run["cer"] = cer([predictions[f] for f in with_gt], [ground_truths[f] for f in with_gt])
+        ## how far the backend drifts from the first one, usually the full precision torch model
+        run["cer_vs_" + runs[0]["backend"]] = cer([predictions[f] for f in predictions], [reference[f] for f in predictions])
+        run["speedup"] = run["images_per_sec"] / runs[0]["images_per_sec"]
+
+        print(f"{run['backend']:>6}: {run['images_per_sec']:.2f} images/s, "
+              f"p50 {run['latency_ms_per_image']['p50']:.0f} ms/image, CER {run['cer']}")
+
+    with open(args.save_path, "w") as f:
+        json.dump(runs, f, indent=2)
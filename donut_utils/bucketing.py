@@ -0,0 +1,129 @@
+import json
+import os
+from collections import defaultdict
+
+from PIL import Image
+from torch.utils.data import Sampler
+
+
+def resized_shape(width: int, height: int, input_size: list, align_long_axis=False) -> tuple:
+    """
+    (width, height) of an image once Donut's encoder.prepare_input has resized it, before padding to input_size
+    """
+
+    input_height, input_width = input_size
+    if align_long_axis and (
+        (input_height > input_width and width > height) or (input_height < input_width and width < height)
+    ):
+        width, height = height, width
+
+    ## shorter side resized to min(input_size)
+    scale = min(input_size) / min(width, height)
+    width, height = width * scale, height * scale
+
+    ## then thumbnailed to fit inside input_size
+    scale = min(1.0, input_width / width, input_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def load_ground_truths(folder: str) -> dict:
+    """
+    ground truth text of every image of a folder, from its Donut metadata.jsonl if there is one
+    """
+
+    ground_truths = {}
+    path = os.path.join(folder, "metadata.jsonl")
+    if not os.path.exists(path):
+        return ground_truths
+
+    with open(path, "r") as f:
+        for line in f:
+            d = json.loads(line)
+            gt = json.loads(d["ground_truth"])["gt_parse"].get("text_sequence", "")
+            ground_truths[d["file_name"]] = gt
+    return ground_truths
+
+
+def load_lengths(folder: str) -> dict:
+    """
+    length of the ground truth text of every image of a folder
+    """
+
+    return {file_name: len(gt) for file_name, gt in load_ground_truths(folder).items()}
+
+
+def bucket_keys(folder: str, file_names: list, input_size: list, max_length: int,
+                align_long_axis=False, shape_step=32, length_step=16) -> tuple:
+    """
+    bucket key (resized width, resized height, expected length, all rounded to their step) and padding
+    efficiency of every image. only image headers are read.
+
+    the expected output length is the ground truth length when the folder has a metadata.jsonl, otherwise it
+    is estimated from the slice size: the share of the encoder input the image covers, times max_length
+    """
+
+    lengths = load_lengths(folder)
+    input_area = input_size[0] * input_size[1]
+
+    keys, efficiencies = [], []
+    for file_name in file_names:
+        with Image.open(f"{folder}/{file_name}") as im:
+            width, height = resized_shape(im.width, im.height, input_size, align_long_axis)
+
+        efficiency = width * height / input_area
+        length = lengths.get(file_name, round(efficiency * max_length))
+
+        keys.append((
+            shape_step * round(width / shape_step),
+            shape_step * round(height / shape_step),
+            length_step * (length // length_step),
+        ))
+        efficiencies.append(efficiency)
+
+    return keys, efficiencies
+
+
+class BucketBatchSampler(Sampler):
+    """
+    batches of dataset indices that share a bucket key, so a batch is only decoded for about as many steps as
+    its images need. buckets are visited from the longest expected output to the shortest
+    """
+
+    def __init__(self, keys: list, batch_size: int):
+        self.batch_size = batch_size
+        buckets = defaultdict(list)
+        for idx, key in enumerate(keys):
+            buckets[key].append(idx)
+
+        self.batches = []
+        for key in sorted(buckets, key=lambda k: (-k[2], k)):
+            indices = buckets[key]
+            for i in range(0, len(indices), batch_size):
+                self.batches.append(indices[i:i + batch_size])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
+def bucket_report(stats: dict) -> list:
+    """
+    per bucket summary of the stats collected during inference, stats maps a bucket key to a dict with
+    images, batches, seconds and the sum of padding efficiencies
+    """
+
+    report = []
+    for key, s in sorted(stats.items(), key=lambda kv: (-kv[0][2], kv[0])):
+        report.append({
+            "resized_width": key[0],
+            "resized_height": key[1],
+            "expected_length": key[2],
+            "images": s["images"],
+            "batches": s["batches"],
+            "seconds": s["seconds"],
+            "images_per_sec": s["images"] / s["seconds"] if s["seconds"] else None,
+            "padding_efficiency": s["efficiency"] / s["images"],
+        })
+    return report
@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+from collections import defaultdict, deque
+from multiprocessing import Pool
+
+
+def edit_distance(a: str, b: str) -> int:
+    """
+    Levenshtein distance between two strings, with Myers' bit-parallel algorithm (Hyyrö's formulation for the
+    global distance). the shorter string is the pattern, held as one Python int bit vector, so a whole column
+    of the DP matrix is updated with a handful of big int operations per character of the longer string
+    """
+
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return len(b)
+
+    peq = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    m = len(a)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & mask
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ## the first row of the matrix grows by one every column
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+    return score
+
+
+def _distances(pairs: list) -> list:
+    return [edit_distance(pred, target) for pred, target in pairs]
+
+
+def load_references(dataset: str) -> dict:
+    """
+    {file_name: (split, ground truth text)} of a Donut dataset folder, either a single split folder with a
+    metadata.jsonl or a folder of split folders (train, test, validation) that each have one, or of a Parquet
+    manifest
+    """
+
+    if dataset.endswith(".parquet"):
+        from manifest import read_manifest
+
+        table = read_manifest(dataset, columns=["file_name", "split", "ground_truth"])
+        return {
+            f: (s, gt) for f, s, gt in zip(*(table.column(c).to_pylist() for c in table.column_names))
+            if gt is not None
+        }
+
+    folders = []
+    if os.path.exists(os.path.join(dataset, "metadata.jsonl")):
+        folders.append((os.path.basename(os.path.normpath(dataset)), dataset))
+    else:
+        for name in sorted(os.listdir(dataset)):
+            if os.path.exists(os.path.join(dataset, name, "metadata.jsonl")):
+                folders.append((name, os.path.join(dataset, name)))
+
+    references = {}
+    for split, folder in folders:
+        with open(os.path.join(folder, "metadata.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                d = json.loads(line)
+                gt = json.loads(d["ground_truth"])["gt_parse"].get("text_sequence", "")
+                references.setdefault(d["file_name"], (split, gt))
+    return references
+
+
+def iter_pairs(results_path: str, references=None):
+    """
+    (file_name, split, prediction, ground truth) of every evaluated sample
+
+    results_path is either a JSONL results file of inferencing.py, matched by file_name against the references,
+    a Parquet manifest with predictions, or the JSON result of Donut's test.py, with the predictions and
+    ground_truths lists side by side. a manifest takes its ground truth from the references when given, either
+    loaded or as the path of a dataset manifest to join with, otherwise from its own ground_truth column
+    """
+
+    if results_path.endswith(".parquet"):
+        yield from _manifest_pairs(results_path, references)
+        return
+
+    if results_path.endswith(".jsonl"):
+        with open(results_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    p = json.loads(line)
+                except json.JSONDecodeError:
+                    ## a half written last line of an interrupted run
+                    continue
+                if p.get("file_name") not in references:
+                    continue
+                split, gt = references[p["file_name"]]
+                yield p["file_name"], split, p.get("text_sequence", ""), gt
+        return
+
+    with open(results_path, "r", encoding="utf-8") as f:
+        res = json.load(f)
+    for i, (p, t) in enumerate(zip(res["predictions"], res["ground_truths"])):
+        yield p.get("file_name", str(i)), "all", p.get("text_sequence", ""), t.get("text_sequence", "")
+
+
+def _manifest_pairs(results_path: str, references=None):
+    from manifest import join_predictions, read_manifest
+
+    if isinstance(references, str):
+        ## joined column to column, nothing goes through python dicts
+        table = join_predictions(read_manifest(references), read_manifest(results_path))
+        references = None
+    else:
+        table = read_manifest(results_path, columns=["file_name", "split", "ground_truth", "prediction"])
+
+    for batch in table.select(["file_name", "split", "ground_truth", "prediction"]).to_batches():
+        columns = batch.to_pydict()
+        for file_name, split, gt, pred in zip(
+            columns["file_name"], columns["split"], columns["ground_truth"], columns["prediction"]
+        ):
+            if references is not None:
+                if file_name not in references:
+                    continue
+                split, gt = references[file_name]
+            if pred is None or gt is None:
+                continue
+            yield file_name, split or "all", pred, gt
+
+
+def _chunks(pairs, chunk_size: int):
+    chunk = []
+    for pair in pairs:
+        chunk.append(pair)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _totals() -> dict:
+    return {"samples": 0, "chars": 0, "errors": 0}
+
+
+def _rate(totals: dict) -> dict:
+    return dict(totals, cer=totals["errors"] / totals["chars"] if totals["chars"] else None)
+
+
+def evaluate(pairs, processes=None, chunk_size=256, length_step=16, per_sample=None) -> dict:
+    """
+    corpus level CER of (file_name, split, prediction, ground truth) samples, plus the same per split and per
+    ground truth length bucket. the samples are streamed in chunks over a process pool, per_sample is an
+    optional open file each sample's errors are written to as a JSON line
+
+    like torchmetrics' CharErrorRate, the CER is the sum of the edit distances over the sum of the ground
+    truth lengths
+    """
+
+    corpus, splits, buckets = _totals(), defaultdict(_totals), defaultdict(_totals)
+
+    ## file names and splits stay here, only the strings go to the workers. imap keeps the order, so the
+    ## results come back in the order the chunks were queued
+    pending = deque()
+
+    def tasks():
+        for chunk in _chunks(pairs, chunk_size):
+            pending.append(chunk)
+            yield [(pred, gt) for _, _, pred, gt in chunk]
+
+    def run(imap):
+        for distances in imap(_distances, tasks()):
+            chunk = pending.popleft()
+            for (file_name, split, pred, gt), errors in zip(chunk, distances):
+                bucket = length_step * (len(gt) // length_step)
+                for totals in (corpus, splits[split], buckets[bucket]):
+                    totals["samples"] += 1
+                    totals["chars"] += len(gt)
+                    totals["errors"] += errors
+                if per_sample is not None:
+                    per_sample.write(json.dumps({
+                        "file_name": file_name, "split": split, "length": len(gt), "errors": errors,
+                        "cer": errors / len(gt) if gt else None, "prediction": pred, "ground_truth": gt,
+                    }, ensure_ascii=False) + "\n")
+
+    if processes == 1:
+        run(map)
+    else:
+        with Pool(processes) as pool:
+            run(lambda f, it: pool.imap(f, it))
+
+    return {
+        "corpus": _rate(corpus),
+        "splits": {split: _rate(t) for split, t in sorted(splits.items())},
+        "length_buckets": [
+            dict(_rate(t), min_length=b, max_length=b + length_step - 1) for b, t in sorted(buckets.items())
+        ],
+    }
+
+
+def torchmetrics_cer(pairs) -> float:
+    """
+    the same corpus CER with torchmetrics, to check the engine against. loads everything in memory
+    """
+
+    from torchmetrics.text import CharErrorRate
+
+    preds, target = [], []
+    for _, _, pred, gt in pairs:
+        preds.append(pred)
+        target.append(gt)
+    return float(CharErrorRate()(preds, target))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="character error rate of Donut predictions")
+    parser.add_argument("results_path", type=str) ## JSONL results or Parquet manifest of inferencing.py, or the JSON result of Donut's test.py
+    parser.add_argument("--dataset", type=str, default=None) ## dataset folder or Parquet manifest with the ground truth, needed for JSONL results
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunk_size", type=int, default=256)
+    parser.add_argument("--length_step", type=int, default=16) ## width of the ground truth length buckets
+    parser.add_argument("--per_sample", type=str, default=None) ## JSONL file with the errors of every sample
+    parser.add_argument("--save_path", type=str, default=None) ## JSON report
+    parser.add_argument("--check", action="store_true") ## also compute the CER with torchmetrics and compare
+    args = parser.parse_args()
+
+    references = None
+    if args.results_path.endswith(".jsonl") and args.dataset is None:
+        parser.error("--dataset is needed to match JSONL results with their ground truth")
+    if args.dataset is not None:
+        if args.results_path.endswith(".parquet") and args.dataset.endswith(".parquet"):
+            references = args.dataset
+        else:
+            references = load_references(args.dataset)
+
+    per_sample = open(args.per_sample, "w", encoding="utf-8") if args.per_sample else None
+    try:
+        report = evaluate(
+            iter_pairs(args.results_path, references), args.processes, args.chunk_size, args.length_step, per_sample
+        )
+    finally:
+        if per_sample is not None:
+            per_sample.close()
+
+    corpus = report["corpus"]
+    print(f"CER {corpus['cer']} ({corpus['errors']} errors over {corpus['chars']} characters, {corpus['samples']} samples)")
+    for split, t in report["splits"].items():
+        print(f"  {split}: CER {t['cer']} over {t['samples']} samples")
+
+    if args.check:
+        reference_cer = torchmetrics_cer(iter_pairs(args.results_path, references))
+        report["torchmetrics_cer"] = reference_cer
+        print(f"torchmetrics CER {reference_cer}")
+        if corpus["cer"] is not None and abs(reference_cer - corpus["cer"]) > 1e-6:
+            raise SystemExit(f"CER mismatch: {corpus['cer']} != torchmetrics {reference_cer}")
+
+    if args.save_path:
+        with open(args.save_path, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
@@ -1,45 +1,464 @@
 import argparse
+import io
 import json
+import math
 import os
-import re
-from pathlib import Path
+import queue
+import time
+import traceback
 
-import numpy as np
-import torch
-from datasets import load_dataset
 from PIL import Image
-from tqdm import tqdm
 
-from donut import DonutModel, JSONParseEvaluator, load_json, save_json
+## torch, donut and everything that imports them are only imported once they are needed, so --help, worker
+## processes that are spawned and scripts importing this module do not pay for them
+from prediction_cache import PredictionCache, model_identity
+from results import ResultWriter, iter_results, load_done, read_results
 
-def test(args):
-    pretrained_model = DonutModel.from_pretrained(args.pretrained_model_name_or_path)
+
+def open_reduced(data: bytes, min_side: int) -> Image.Image:
+    """
+    decoded image, reduced when it is larger than Donut's prepare_input needs: prepare_input first resizes the
+    shorter side to min(input_size) (align_long_axis only swaps the sides), so the image is decoded no smaller than
+    that. jpegs are DCT-scaled in the decoder (draft, by 1/2, 1/4 or 1/8), other formats are box-reduced by an
+    integer factor right after decoding
+    """
+
+    image = Image.open(io.BytesIO(data))
+    scale = min_side / min(image.size)
+    if scale < 1 and image.format == "JPEG":
+        ## draft keeps the decoded size at or above the requested one
+        image.draft(image.mode, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    image.load()
+
+    factor = min(image.size) // min_side
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+
+def check_reduced_decode(dataset, count=16, tolerance=0.02) -> dict:
+    """
+    model inputs of reduced decoding against the full decode, on count images spread over the dataset: absolute
+    difference of the preprocessed tensors (normalized to [-1, 1]) as the mean over all images, the mean of the
+    worst image and the largest single value, and the decode times. ok when the mean difference of every image
+    is within tolerance
+    """
+
+    file_names = dataset.file_names[::max(1, len(dataset.file_names) // count)][:count]
+    mean_diffs, max_diffs, full_s, reduced_s = [], [], 0.0, 0.0
+    for file_name in file_names:
+        with open(f"{dataset.folder}/{file_name}", "rb") as f:
+            data = f.read()
+
+        start = time.perf_counter()
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        full_s += time.perf_counter() - start
+        full = dataset.prepare_input(image, random_padding=False)
+
+        start = time.perf_counter()
+        image = open_reduced(data, dataset.min_side)
+        reduced_s += time.perf_counter() - start
+        diff = (dataset.prepare_input(image, random_padding=False) - full).abs()
+
+        mean_diffs.append(diff.mean().item())
+        max_diffs.append(diff.max().item())
+
+    return {
+        "images": len(file_names),
+        "mean_abs_diff": sum(mean_diffs) / max(1, len(mean_diffs)),
+        "worst_mean_abs_diff": max(mean_diffs, default=0.0),
+        "max_abs_diff": max(max_diffs, default=0.0),
+        "full_decode_ms": 1000 * full_s / max(1, len(file_names)),
+        "reduced_decode_ms": 1000 * reduced_s / max(1, len(file_names)),
+        "ok": max(mean_diffs, default=0.0) <= tolerance,
+    }
+
+
+def cache_model_id(pretrained_model_name_or_path: str, backend: str, min_side=None) -> str:
+    """
+    model id of the prediction cache: the checkpoint identity, the backend and, with reduced decoding, the size
+    images are decoded at. none of them give identical predictions, so each gets its own entries
+    """
+
+    model_id = f"{model_identity(pretrained_model_name_or_path)}:{backend}"
+    if min_side:
+        model_id += f":reduced{min_side}"
+    return model_id
+
+
+class ImageFolderDataset:
+    """
+    jpg images of a folder in sorted order, decoded and preprocessed for the Donut encoder by the loader
+    workers while the model runs on the previous batch. images in skip are left out. a map-style dataset for
+    torch's DataLoader, which only needs __len__ and __getitem__
+
+    with a prediction cache, images are looked up by content hash first and cache hits are neither decoded
+    nor sent to the model. with min_side, images are decoded at reduced size, see open_reduced
+    """
+
+    def __init__(self, folder: str, prepare_input, skip=(), cache: PredictionCache = None, min_side=None):
+        self.folder = folder
+        self.prepare_input = prepare_input
+        self.cache = cache
+        self.min_side = min_side
+        self.file_names = sorted(
+            os.fsdecode(f) for f in os.listdir(os.fsencode(folder))
+            if os.fsdecode(f).endswith(".jpg") and os.fsdecode(f) not in skip
+        )
+
+    def __len__(self) -> int:
+        return len(self.file_names)
+
+    def __getitem__(self, idx: int):
+        file_name = self.file_names[idx]
+        with open(f"{self.folder}/{file_name}", "rb") as f:
+            data = f.read()
+
+        key, cached = None, None
+        if self.cache is not None:
+            key = self.cache.key(data)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return None, file_name, idx, key, cached, None
+
+        start = time.perf_counter()
+        if self.min_side:
+            image = open_reduced(data, self.min_side)
+        else:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        decoded = time.perf_counter()
+        ## resized and padded to the encoder input size, so every image of a batch has the same shape
+        image_tensor = self.prepare_input(image, random_padding=False)
+        load_times = {"decode": decoded - start, "preprocess": time.perf_counter() - decoded}
+        return image_tensor, file_name, idx, key, None, load_times
+
+
+def collate(batch):
+    """
+    (image_tensors, file_names, indices, cache keys, cached predictions, load times), only the images without
+    a cached prediction are stacked into image_tensors, which is None when the whole batch was cached
+    """
+
+    import torch
+
+    image_tensors, file_names, indices, keys, cached, load_times = zip(*batch)
+    image_tensors = [t for t in image_tensors if t is not None]
+    return (
+        torch.stack(image_tensors) if image_tensors else None,
+        list(file_names), list(indices), list(keys), list(cached), list(load_times),
+    )
+
+
+def run_batch(model, image_tensors, prompt_tensors, cached, load_times=None, instrument=False) -> tuple:
+    """
+    predictions of a batch, in order: cached ones as they are, the others from the model. with instrument,
+    also the per image latency records of the images that went through the model, else None
+    """
+
+    outputs, records = iter(()), None
+    if image_tensors is not None:
+        prompt_tensors = prompt_tensors.expand(image_tensors.size(0), -1)
+        if instrument:
+            from instrumentation import instrumented_inference
+
+            predictions, model_records = instrumented_inference(model, image_tensors, prompt_tensors)
+            times = iter(t for t in load_times if t is not None)
+            records = [dict(next(times), **r) for r in model_records]
+            outputs = iter(predictions)
+        else:
+            outputs = iter(model.inference(image_tensors=image_tensors, prompt_tensors=prompt_tensors)["predictions"])
+
+    outputs = [c if c is not None else next(outputs) for c in cached]
+    if records is not None:
+        ## aligned with the whole batch, cached images have no record
+        records = iter(records)
+        records = [None if c is not None else next(records) for c in cached]
+    return outputs, records
+
+
+def run_local(model, loader, prompt_tensors, instrument=False):
+    """
+    run the batches of the loader in this process, yields (outputs, file_names, indices, seconds, keys, cached,
+    records) per batch
+    """
+
+    import torch
+
+    with torch.no_grad():
+        for image_tensors, file_names, indices, keys, cached, load_times in loader:
+            start = time.perf_counter()
+            outputs, records = run_batch(model, image_tensors, prompt_tensors, cached, load_times, instrument)
+            yield outputs, file_names, indices, time.perf_counter() - start, keys, cached, records
+
+
+def _inference_worker(model, dataset, prompt_tensors, work, results, threads, instrument):
+    """
+    worker process: takes batches of dataset indices from the work queue until it gets None, decodes them
+    and puts (outputs, file_names, indices, seconds, keys, cached, records) on the results queue
+    """
+
+    import torch
+
+    torch.set_num_threads(threads)
+    try:
+        with torch.no_grad():
+            while True:
+                batch = work.get()
+                if batch is None:
+                    break
+                image_tensors, file_names, indices, keys, cached, load_times = collate([dataset[i] for i in batch])
+                start = time.perf_counter()
+                outputs, records = run_batch(model, image_tensors, prompt_tensors, cached, load_times, instrument)
+                results.put((outputs, file_names, indices, time.perf_counter() - start, keys, cached, records))
+        results.put(None)
+    except Exception:
+        results.put(traceback.format_exc())
+
+
+def run_workers(model, dataset, batches, prompt_tensors, num_procs, threads=None, instrument=False):
+    """
+    run the batches over num_procs forked worker processes pulling from a shared work queue, yields
+    (outputs, file_names, indices, seconds, keys, cached, records) per batch as they finish. the weights are moved to shared
+    memory once, so every worker uses the same copy instead of its own
+    """
+
+    import torch
 
     if torch.cuda.is_available():
-        pretrained_model.half()
-        pretrained_model.to("cuda")
+        raise ValueError("--num_procs is meant for CPU inference")
+
+    threads = threads or max(1, (os.cpu_count() or 1) // num_procs)
+    model.share_memory()
+
+    ctx = torch.multiprocessing.get_context("fork")
+    work, results = ctx.Queue(), ctx.Queue()
+
+    procs = [
+        ctx.Process(target=_inference_worker, args=(model, dataset, prompt_tensors, work, results, threads, instrument), daemon=True)
+        for _ in range(num_procs)
+    ]
+    for p in procs:
+        p.start()
+
+    for batch in batches:
+        work.put(batch)
+    for _ in range(num_procs):
+        work.put(None)
+
+    try:
+        running = num_procs
+        while running:
+            try:
+                r = results.get(timeout=1)
+            except queue.Empty:
+                ## a worker killed from outside (e.g. by the OOM killer) never puts its None or traceback, a
+                ## worker that finished or failed normally exits with 0 after its last put
+                dead = [p.exitcode for p in procs if p.exitcode not in (None, 0)]
+                if dead:
+                    raise RuntimeError(f"Inference worker died with exit code {dead[0]}")
+                continue
+            if r is None:
+                running -= 1
+            elif isinstance(r, str):
+                raise RuntimeError(f"Inference worker failed:\n{r}")
+            else:
+                yield r
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+
+def write_manifest(args, predictions, inference_ms: dict) -> None:
+    """
+    Parquet manifest of the predictions, with the ground truth when the folder has a metadata.jsonl and the
+    model time of the images run (not cached, not resumed) this time
+    """
+
+    from bucketing import load_ground_truths
+    from manifest import ManifestWriter
+
+    split = os.path.basename(os.path.normpath(args.dataset_name_or_path))
+    ground_truths = load_ground_truths(args.dataset_name_or_path)
+    with ManifestWriter(args.manifest_path) as manifest:
+        for output in predictions:
+            file_name = output["file_name"]
+            manifest.write(
+                file_name=file_name,
+                shard=split,
+                split=split,
+                ground_truth=ground_truths.get(file_name),
+                prediction=output.get("text_sequence", ""),
+                inference_ms=inference_ms.get(file_name),
+            )
+
+
+def test(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from tqdm import tqdm
+
+    from donut import save_json
+
+    from backends import load_model
+    from bucketing import BucketBatchSampler, bucket_keys, bucket_report
+    from instrumentation import LatencyReport
+    from metrics import Metrics
 
-    pretrained_model.eval()
+    pretrained_model = load_model(args.pretrained_model_name_or_path, args.backend, args.onnx_path)
 
     if args.save_path:
         os.makedirs(os.path.dirname(args.save_path), exist_ok=True)
 
+    ## predictions are streamed to the results file as they finish, only kept in memory without one
     predictions = []
+    results_path = args.results_path
+    if results_path is None and args.save_path:
+        results_path = os.path.splitext(args.save_path)[0] + ".jsonl"
 
-    folder = os.fsencode(args.dataset_name_or_path)
-    images = os.listdir(folder)
+    done = load_done(results_path) if results_path and args.resume else set()
+    if done:
+        print(f"Resuming, {len(done)} images already in {results_path}")
+    writer = ResultWriter(results_path, args.resume, args.fsync_interval) if results_path else None
 
-    for idx, sample in tqdm(enumerate(images), total=len(images)):
+    dataset = ImageFolderDataset(args.dataset_name_or_path, pretrained_model.encoder.prepare_input, done)
+    if args.reduced_decode:
+        dataset.min_side = min(pretrained_model.encoder.input_size)
+        if args.decode_check > 0:
+            check = check_reduced_decode(dataset, args.decode_check, args.decode_tolerance)
+            print(f"Reduced decode: {check['reduced_decode_ms']:.1f} ms instead of {check['full_decode_ms']:.1f} ms per image, "
+                  f"input difference mean {check['mean_abs_diff']:.4f}, worst image mean {check['worst_mean_abs_diff']:.4f}, "
+                  f"max {check['max_abs_diff']:.4f}")
+            if not check["ok"]:
+                ## inputs too far from the full decode, the predictions would not be comparable
+                print(f"Worst image mean difference above {args.decode_tolerance}, decoding at full size")
+                dataset.min_side = None
 
-        if os.fsdecode(sample).endswith(".jpg"):
-            image = Image.open(f"{args.dataset_name_or_path}/{os.fsdecode(sample)}")
-        else:
-            continue
-        output = pretrained_model.inference(image=image, prompt=f"<s_{args.task_name}>")["predictions"][0]
+    ## only once the decode mode is settled, it is part of the cache namespace
+    cache = None
+    if args.cache_path:
+        cache = PredictionCache(
+            args.cache_path,
+            cache_model_id(args.pretrained_model_name_or_path, args.backend, dataset.min_side),
+            f"<s_{args.task_name}>",
+            int(args.cache_max_mb * 2 ** 20),
+        )
+        dataset.cache = cache
+
+    if args.bucket:
+        ## group images by resized shape and expected output length, decoding runs as long as the longest output
+        bucket_of, efficiencies = bucket_keys(
+            args.dataset_name_or_path,
+            dataset.file_names,
+            pretrained_model.encoder.input_size,
+            pretrained_model.config.max_length,
+            pretrained_model.encoder.align_long_axis,
+        )
+        batches = list(BucketBatchSampler(bucket_of, args.batch_size))
+        bucket_stats = {}
+    else:
+        batches = [list(range(i, min(i + args.batch_size, len(dataset)))) for i in range(0, len(dataset), args.batch_size)]
+
+    prompt_tensors = pretrained_model.decoder.tokenizer(
+        f"<s_{args.task_name}>", add_special_tokens=False, return_tensors="pt"
+    )["input_ids"]
+
+    ## per image latency of every stage, only when a report is asked for
+    instrument = bool(args.latency_report)
+    latency = LatencyReport() if instrument else None
+
+    if args.num_procs > 1:
+        done_batches = run_workers(
+            pretrained_model, dataset, batches, prompt_tensors, args.num_procs, args.threads_per_proc, instrument
+        )
+    else:
+        if args.threads_per_proc:
+            torch.set_num_threads(args.threads_per_proc)
+        loader = DataLoader(dataset, batch_sampler=batches, num_workers=args.num_workers, collate_fn=collate)
+        done_batches = run_local(pretrained_model, loader, prompt_tensors, instrument)
+
+    ## model time per image of this run, for the manifest
+    inference_ms = {}
+
+    metrics = Metrics("inferencing", args.metrics_path, args.metrics_port, total=len(dataset))
+    finished = 0
+
+    try:
+        with tqdm(total=len(dataset)) as pbar:
+            for outputs, file_names, indices, seconds, keys, cached, records in done_batches:
+                if args.manifest_path:
+                    misses = sum(hit is None for hit in cached)
+                    for file_name, hit in zip(file_names, cached):
+                        if hit is None:
+                            inference_ms[file_name] = 1000 * seconds / misses
+                if records is not None:
+                    for file_name, record in zip(file_names, records):
+                        if record is not None:
+                            latency.add(file_name, record)
+
+                for output, file_name, idx, key, hit in zip(outputs, file_names, indices, keys, cached):
+                    if cache is not None:
+                        if hit is not None:
+                            cache.hits += 1
+                        else:
+                            cache.misses += 1
+                            cache.put(key, output)
+                    output['file_name'] = file_name
+                    if writer:
+                        writer.write(output)
+                    else:
+                        predictions.append((idx, output))
+
+                if args.bucket:
+                    s = bucket_stats.setdefault(bucket_of[indices[0]], {"images": 0, "batches": 0, "seconds": 0.0, "efficiency": 0.0})
+                    s["images"] += len(indices)
+                    s["batches"] += 1
+                    s["seconds"] += seconds
+                    s["efficiency"] += sum(efficiencies[i] for i in indices)
+
+                pbar.update(len(file_names))
+
+                finished += 1
+                metrics.done(len(file_names))
+                metrics.inc("cache_hits_total", sum(hit is not None for hit in cached))
+                metrics.set("queue_depth", len(batches) - finished, queue="batches")
+    except Exception as e:
+        metrics.error(e)
+        raise
+    finally:
+        metrics.close()
+
+    if writer:
+        writer.close()
+        ## the final json is only built from the stream when it is asked for
+        predictions = read_results(results_path) if args.save_path else []
+    else:
+        ## back to input order
+        predictions = [output for _, output in sorted(predictions, key=lambda p: p[0])]
+
+    if args.manifest_path:
+        write_manifest(args, iter_results(results_path) if writer else predictions, inference_ms)
+
+    if latency is not None:
+        summary = latency.save(args.latency_report)
+        if summary["images"]:
+            print(f"{summary['images_per_sec']:.2f} images/s, {summary['tokens_per_sec']:.1f} tokens/s, "
+                  f"p50 {summary['latency']['total']['p50_ms']:.0f} ms, p99 {summary['latency']['total']['p99_ms']:.0f} ms per image")
 
-        output['file_name'] = os.fsdecode(sample)
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Prediction cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
 
-        predictions.append(output)
+    if args.bucket:
+        report = bucket_report(bucket_stats)
+        for b in report:
+            print(f"bucket {b['resized_width']}x{b['resized_height']} len~{b['expected_length']}: "
+                  f"{b['images']} images, {b['images_per_sec']:.2f} images/s, padding efficiency {b['padding_efficiency']:.0%}")
+        if args.bucket_report:
+            save_json(args.bucket_report, report)
 
     if args.save_path:
         save_json(args.save_path, predictions)
@@ -53,7 +472,27 @@ if __name__ == "__main__":
     parser.add_argument("--dataset_name_or_path", type=str) ## path of dir of images we want to inference
     parser.add_argument("--split", type=str, default="test")
     parser.add_argument("--task_name", type=str, default=None) ## task_name is the name of the dataset the model was trained on
-    parser.add_argument("--save_path", type=str, default=None)
+    parser.add_argument("--save_path", type=str, default=None) ## final json of all predictions, built from the results file
+    parser.add_argument("--results_path", type=str, default=None) ## jsonl file predictions are appended to as they finish, defaults to save_path with .jsonl
+    parser.add_argument("--resume", action="store_true") ## skip the images that already are in the results file
+    parser.add_argument("--fsync_interval", type=float, default=30.0) ## seconds between fsyncs of the results file
+    parser.add_argument("--backend", type=str, default="torch") ## torch, int8 (dynamic quantization) or onnx (onnxruntime encoder), the last two CPU only
+    parser.add_argument("--onnx_path", type=str, default=None) ## where the exported encoder is kept, defaults to a per checkpoint file under ~/.cache/donut_utils/onnx
+    parser.add_argument("--batch_size", type=int, default=1) ## number of images run through the model at once
+    parser.add_argument("--num_workers", type=int, default=2) ## loader processes decoding images while the model runs
+    parser.add_argument("--num_procs", type=int, default=1) ## worker processes, each running its own batches on the shared model weights
+    parser.add_argument("--threads_per_proc", type=int, default=None) ## torch threads per process, defaults to cpu count / num_procs
+    parser.add_argument("--cache_path", type=str, default=None) ## sqlite prediction cache shared across runs, keyed by image hash, model, backend, decode size and prompt
+    parser.add_argument("--cache_max_mb", type=float, default=1024) ## size above which least recently used predictions are evicted
+    parser.add_argument("--manifest_path", type=str, default=None) ## Parquet manifest of the predictions, with ground truth and model time per image. needs pyarrow
+    parser.add_argument("--latency_report", type=str, default=None) ## json file for per stage latency percentiles, tokens/s and the slowest images
+    parser.add_argument("--bucket", action="store_true") ## batch images of similar shape and expected output length together
+    parser.add_argument("--bucket_report", type=str, default=None) ## json file for the per bucket throughput and padding efficiency
+    parser.add_argument("--metrics_path", type=str, default=None) ## Prometheus text file with live images/s, queue depth, worker memory and ETA
+    parser.add_argument("--metrics_port", type=int, default=None) ## serve the same metrics on this local port
+    parser.add_argument("--reduced_decode", action="store_true") ## decode large images near the encoder input size (jpeg draft, reduce)
+    parser.add_argument("--decode_check", type=int, default=16) ## images compared against the full decode before using --reduced_decode, 0 to skip
+    parser.add_argument("--decode_tolerance", type=float, default=0.02) ## largest mean absolute difference of the model inputs of any checked image, on the [-1, 1] scale
     args, left_argv = parser.parse_known_args()
 
     if args.task_name is None:
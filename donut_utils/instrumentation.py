@@ -0,0 +1,138 @@
+import json
+import re
+import time
+
+import numpy as np
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+from transformers.file_utils import ModelOutput
+
+STAGES = ["decode", "preprocess", "encoder", "decoder", "parse"]
+
+
+class StepTimer(LogitsProcessor):
+    """
+    logits processor that only records when each autoregressive decoding step finished
+    """
+
+    def __init__(self):
+        self.times = [time.perf_counter()]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self.times.append(time.perf_counter())
+        return scores
+
+
+def _sync(model) -> None:
+    if model.device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def instrumented_inference(model, image_tensors: torch.Tensor, prompt_tensors: torch.Tensor) -> tuple:
+    """
+    same as DonutModel.inference on a batch of image tensors, but timed stage by stage
+
+    returns the predictions and one record per image with the encoder forward, autoregressive decoding and
+    json parse time in seconds, the number of generated tokens and the mean decoding step time. batch level
+    times are shared out evenly over the images of the batch
+    """
+
+    batch_size = image_tensors.size(0)
+    if model.device.type == "cuda":
+        image_tensors = image_tensors.half().to(model.device)
+    prompt_tensors = prompt_tensors.to(model.device)
+
+    start = time.perf_counter()
+    last_hidden_state = model.encoder(image_tensors)
+    if model.device.type != "cuda":
+        last_hidden_state = last_hidden_state.to(torch.float32)
+    _sync(model)
+    encoder_seconds = time.perf_counter() - start
+
+    step_timer = StepTimer()
+    decoder_output = model.decoder.model.generate(
+        decoder_input_ids=prompt_tensors,
+        encoder_outputs=ModelOutput(last_hidden_state=last_hidden_state, attentions=None),
+        max_length=model.config.max_length,
+        early_stopping=True,
+        pad_token_id=model.decoder.tokenizer.pad_token_id,
+        eos_token_id=model.decoder.tokenizer.eos_token_id,
+        use_cache=True,
+        num_beams=1,
+        bad_words_ids=[[model.decoder.tokenizer.unk_token_id]],
+        return_dict_in_generate=True,
+        logits_processor=LogitsProcessorList([step_timer]),
+    )
+    _sync(model)
+    decoder_seconds = time.perf_counter() - step_timer.times[0]
+    steps = np.diff(step_timer.times)
+
+    generated = decoder_output.sequences[:, prompt_tensors.size(1):]
+    tokens = (generated != model.decoder.tokenizer.pad_token_id).sum(dim=1).tolist()
+
+    predictions, records = [], []
+    for seq, n_tokens in zip(model.decoder.tokenizer.batch_decode(decoder_output.sequences), tokens):
+        start = time.perf_counter()
+        seq = seq.replace(model.decoder.tokenizer.eos_token, "").replace(model.decoder.tokenizer.pad_token, "")
+        seq = re.sub(r"<.*?>", "", seq, count=1).strip()  # remove first task start token
+        predictions.append(model.token2json(seq))
+        records.append({
+            "encoder": encoder_seconds / batch_size,
+            "decoder": decoder_seconds / batch_size,
+            "parse": time.perf_counter() - start,
+            "tokens": n_tokens,
+            "decode_steps": len(steps),
+            "step_ms": 1000 * float(steps.mean()) if len(steps) else 0.0,
+        })
+
+    return predictions, records
+
+
+def _percentiles(values, scale=1000, unit="ms") -> dict:
+    values = np.asarray(values) * scale
+    return {
+        f"mean_{unit}": float(values.mean()),
+        f"p50_{unit}": float(np.percentile(values, 50)),
+        f"p95_{unit}": float(np.percentile(values, 95)),
+        f"p99_{unit}": float(np.percentile(values, 99)),
+    }
+
+
+class LatencyReport:
+    """
+    collects the per image records of an instrumented run and summarizes them for capacity planning
+    """
+
+    def __init__(self):
+        self.records = []
+        self.start = time.perf_counter()
+
+    def add(self, file_name: str, record: dict) -> None:
+        record = dict(record, file_name=file_name)
+        record["total"] = sum(record.get(stage, 0.0) for stage in STAGES)
+        self.records.append(record)
+
+    def summary(self, slowest=20) -> dict:
+        wall = time.perf_counter() - self.start
+        if not self.records:
+            return {"images": 0, "seconds": wall}
+
+        tokens = sum(r["tokens"] for r in self.records)
+        decoder_seconds = sum(r["decoder"] for r in self.records)
+        return {
+            "images": len(self.records),
+            "seconds": wall,
+            "images_per_sec": len(self.records) / wall,
+            "tokens": tokens,
+            "tokens_per_sec": tokens / wall,
+            "decoder_tokens_per_sec": tokens / decoder_seconds if decoder_seconds else None,
+            "latency": {stage: _percentiles([r.get(stage, 0.0) for r in self.records]) for stage in STAGES + ["total"]},
+            "tokens_per_image": _percentiles([r["tokens"] for r in self.records], 1, "tokens"),
+            "slowest": sorted(self.records, key=lambda r: r["total"], reverse=True)[:slowest],
+        }
+
+    def save(self, path: str, slowest=20) -> dict:
+        summary = self.summary(slowest)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        return summary
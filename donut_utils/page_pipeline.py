@@ -0,0 +1,289 @@
+import argparse
+import os
+import queue
+import sys
+import threading
+import traceback
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mageXML"))
+
+from magexml import decide_slices, group_by_column, parse_xml, slice_img
+
+
+class PageJob:
+    """
+    one page going through the pipeline: its PageXML, slices and the predictions of the slices as they come in
+    """
+
+    def __init__(self, xml_path: str, page, image=None):
+        self.xml_path = xml_path
+        self.page = page
+        self.image = image
+        self.slices = []
+        self.predictions = []
+        self.remaining = 0
+
+
+def _baseline_key(points) -> tuple:
+    return tuple(int(round(float(v))) for p in points for v in p)
+
+
+def _parse_points(points: str) -> list:
+    return [tuple(float(v) for v in p.split(",")) for p in points.split()]
+
+
+def estimate_char_width(page) -> float:
+    """
+    rough width in pixels of one character on the page: half the median distance between consecutive
+    baselines of a column
+    """
+
+    gaps = []
+    for lines in group_by_column(page).values():
+        ys = sorted(float(np.mean(line.bl_pts[:, 1])) for line in lines)
+        gaps.extend(b - a for a, b in zip(ys, ys[1:]) if b > a)
+    if not gaps:
+        return 0.01 * float(page.get_image_dims()[0])
+    return max(1.0, 0.5 * float(np.median(gaps)))
+
+
+def split_text(text: str, widths: list) -> list:
+    """
+    split the prediction of a slice over its lines in proportion to their baseline widths, each cut moved to
+    the closest space when there is one nearby
+    """
+
+    if len(widths) == 1:
+        return [text]
+
+    total = float(sum(widths)) or 1.0
+    cuts, start, acc = [], 0, 0.0
+    for w in widths[:-1]:
+        acc += w
+        cut = max(start, min(len(text), int(round(len(text) * acc / total))))
+        window = max(2, len(text) // (4 * len(widths)))
+        spaces = [i for i in range(max(start, cut - window), min(len(text), cut + window) + 1)
+                  if i < len(text) and text[i] == " "]
+        if spaces:
+            cut = min(spaces, key=lambda i: abs(i - cut)) + 1
+        cuts.append(cut)
+        start = cut
+
+    bounds = [0] + cuts + [len(text)]
+    return [text[a:b].strip() for a, b in zip(bounds, bounds[1:])]
+
+
+def _set_text(element, ns: str, text: str, before: tuple) -> None:
+    """
+    set the TextEquiv/Unicode of a TextLine or TextRegion element, the TextEquiv goes right after the last
+    child with a tag in before, as the PAGE schema orders them
+    """
+
+    equiv = element.find(f"{ns}TextEquiv")
+    if equiv is None:
+        equiv = ET.Element(f"{ns}TextEquiv")
+        position = 0
+        for i, child in enumerate(element):
+            if child.tag in before:
+                position = i + 1
+        element.insert(position, equiv)
+
+    for plain in equiv.findall(f"{ns}PlainText"):
+        equiv.remove(plain)
+    unicode = equiv.find(f"{ns}Unicode")
+    if unicode is None:
+        unicode = ET.SubElement(equiv, f"{ns}Unicode")
+    unicode.text = text
+
+
+def write_page(job: PageJob, out_dir: str) -> str:
+    """
+    write the predictions of a page into a copy of its PageXML: every line of a slice gets its share of the
+    slice's prediction as TextEquiv/Unicode, every region the text of its lines. lines are matched to the
+    slices by their baseline points
+    """
+
+    tree = ET.parse(job.xml_path)
+    root = tree.getroot()
+    ns = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+    if ns:
+        ET.register_namespace("", ns[1:-1])
+
+    texts = {}
+    for s, prediction in zip(job.slices, job.predictions):
+        lines = s["lines"]
+        widths = [float(np.ptp(line.bl_pts[:, 0])) for line in lines]
+        for line, text in zip(lines, split_text(prediction.get("text_sequence", ""), widths)):
+            texts[_baseline_key(line.bl_pts)] = text
+
+    for region in root.iter(f"{ns}TextRegion"):
+        region_lines = []
+        for line in region.findall(f"{ns}TextLine"):
+            baseline = line.find(f"{ns}Baseline")
+            if baseline is None:
+                continue
+            key = _baseline_key(_parse_points(baseline.get("points")))
+            if key in texts:
+                _set_text(line, ns, texts[key], (f"{ns}AlternativeImage", f"{ns}Coords", f"{ns}Baseline", f"{ns}Word"))
+                region_lines.append(texts[key])
+        if region_lines:
+            _set_text(region, ns, "\n".join(region_lines), (f"{ns}AlternativeImage", f"{ns}Coords", f"{ns}TextLine"))
+
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, os.path.basename(job.xml_path))
+    tree.write(out_path, encoding="utf-8", xml_declaration=True)
+    return out_path
+
+
+def _read_pages(xml_paths: list, image_dir: str, out: queue.Queue) -> None:
+    ## stage 1: parse the PageXML and decode the scan
+    try:
+        for xml_path in xml_paths:
+            try:
+                page = parse_xml(xml_path)
+                image_name = page.get_image_data()[0]
+                image = Image.open(os.path.join(image_dir, image_name) if image_dir else image_name)
+                image.load()
+                out.put(PageJob(xml_path, page, image))
+            except Exception as e:
+                print(f"Error with file: {xml_path}")
+                print(f'    {e}')
+                traceback.print_exc()
+    finally:
+        out.put(None)
+
+
+def _slice_pages(pages: queue.Queue, out: queue.Queue, prepare_input, pred_length: int) -> None:
+    ## stage 2: decide the slices from the baselines, crop them from the image in memory and preprocess them
+    try:
+        while True:
+            job = pages.get()
+            if job is None:
+                break
+            try:
+                char_width = estimate_char_width(job.page)
+                line_length = lambda line: int(np.ptp(line.bl_pts[:, 0]) / char_width)
+                job.slices = decide_slices(job.page, pred_length, line_length, keep_long_lines=True)
+                ## lines estimated longer than pred_length are still transcribed, on their own, but the prediction
+                ## may stop before the end of the line
+                long_lines = sum(1 for s in job.slices if len(s["lines"]) == 1 and line_length(s["lines"][0]) > pred_length)
+                if long_lines:
+                    print(f"{job.xml_path}: {long_lines} line(s) longer than pred_length={pred_length}, may be truncated")
+                job.predictions = [None] * len(job.slices)
+                job.remaining = len(job.slices)
+
+                image = job.image.convert("RGB")
+                job.image = None
+                ## all crops of a page first, so a failing page never reaches the model half done
+                tensors = [
+                    prepare_input(slice_img(job.page, s["coords"], image=image), random_padding=False)
+                    for s in job.slices
+                ]
+                if not tensors:
+                    out.put((job, None, None))
+                for i, tensor in enumerate(tensors):
+                    out.put((job, i, tensor))
+            except Exception as e:
+                print(f"Error with file: {job.xml_path}")
+                print(f'    {e}')
+                traceback.print_exc()
+    finally:
+        out.put(None)
+
+
+def _write_pages(pages: queue.Queue, out_dir: str, verbose: bool) -> None:
+    ## stage 4: write the transcribed PageXML
+    while True:
+        job = pages.get()
+        if job is None:
+            break
+        try:
+            out_path = write_page(job, out_dir)
+            if verbose:
+                print(f"Transcribed page: {out_path}")
+        except Exception as e:
+            print(f"Error with file: {job.xml_path}")
+            print(f'    {e}')
+            traceback.print_exc()
+
+
+def transcribe_pages(model, xml_paths: list, image_dir: str, out_dir: str, task_name: str,
+                     batch_size=8, pred_length=140, prefetch=64, verbose=True) -> None:
+    """
+    transcribe pages end to end without intermediate files: PageXML and scan in, PageXML with the predicted
+    text out. reading, slicing and writing run in their own threads while the model runs in this one, so
+    decoding and slicing of the next pages overlap with inference on the current batch
+    """
+
+    import torch
+
+    pages, crops, done = queue.Queue(maxsize=4), queue.Queue(maxsize=prefetch), queue.Queue()
+    threads = [
+        threading.Thread(target=_read_pages, args=(xml_paths, image_dir, pages), daemon=True),
+        threading.Thread(target=_slice_pages, args=(pages, crops, model.encoder.prepare_input, pred_length), daemon=True),
+        threading.Thread(target=_write_pages, args=(done, out_dir, verbose), daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    prompt_tensors = model.decoder.tokenizer(
+        f"<s_{task_name}>", add_special_tokens=False, return_tensors="pt"
+    )["input_ids"]
+
+    def run(batch):
+        ## stage 3: batched inference, a page is handed to the writer once all of its slices are predicted
+        image_tensors = torch.stack([tensor for _, _, tensor in batch])
+        outputs = model.inference(
+            image_tensors=image_tensors, prompt_tensors=prompt_tensors.expand(image_tensors.size(0), -1)
+        )["predictions"]
+        for (job, i, _), output in zip(batch, outputs):
+            job.predictions[i] = output
+            job.remaining -= 1
+            if job.remaining == 0:
+                done.put(job)
+
+    try:
+        batch = []
+        with torch.no_grad():
+            while True:
+                item = crops.get()
+                if item is None:
+                    break
+                if item[1] is None:
+                    done.put(item[0])
+                    continue
+                batch.append(item)
+                if len(batch) == batch_size:
+                    run(batch)
+                    batch = []
+            if batch:
+                run(batch)
+    finally:
+        done.put(None)
+        threads[2].join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="transcribe PageXML pages with Donut, straight from the scans")
+    parser.add_argument("--pretrained_model_name_or_path", type=str)
+    parser.add_argument("--xml_dir", type=str, default="pages") ## PageXML files with baselines
+    parser.add_argument("--image_dir", type=str, default="raw_images") ## the scans of the pages
+    parser.add_argument("--out_dir", type=str, default="transcribed") ## PageXML files with the predicted text
+    parser.add_argument("--task_name", type=str)
+    parser.add_argument("--backend", type=str, default="torch") ## torch, int8 or onnx, see backends.py
+    parser.add_argument("--onnx_path", type=str, default=None)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--pred_length", type=int, default=140) ## the pred_length the slices of the training data were made with
+    args, left_argv = parser.parse_known_args()
+
+    from backends import load_model
+
+    model = load_model(args.pretrained_model_name_or_path, args.backend, args.onnx_path)
+    xml_paths = sorted(
+        os.path.join(args.xml_dir, f) for f in os.listdir(args.xml_dir) if f.endswith(".xml")
+    )
+    transcribe_pages(model, xml_paths, args.image_dir, args.out_dir, args.task_name, args.batch_size, args.pred_length)
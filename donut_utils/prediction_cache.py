@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def model_identity(pretrained_model_name_or_path: str) -> str:
+    """
+    identity of a model checkpoint: for a local checkpoint folder the name, size and modification time of its
+    files, so retraining into the same folder gives a new identity. otherwise the hub name itself
+    """
+
+    if not os.path.isdir(pretrained_model_name_or_path):
+        return pretrained_model_name_or_path
+
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(pretrained_model_name_or_path)):
+        st = os.stat(os.path.join(pretrained_model_name_or_path, name))
+        h.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()
+
+
+class PredictionCache:
+    """
+    on disk cache of predictions keyed by (image content hash, model checkpoint identity, task prompt)
+
+    backed by sqlite in WAL mode, so any number of processes can read and write the same cache file. every
+    process opens its own connection, also after a fork. once the stored predictions exceed max_bytes the
+    least recently used ones are evicted
+    """
+
+    def __init__(self, path: str, model_id: str, prompt: str, max_bytes=1 << 30):
+        self.path = path
+        self.namespace = hashlib.sha256(f"{model_id}\0{prompt}".encode()).hexdigest()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self._conn = None
+        self._pid = None
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        ## connections do not cross process boundaries
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    def key(self, image_bytes: bytes) -> str:
+        return hashlib.sha256(self.namespace.encode() + hashlib.sha256(image_bytes).digest()).hexdigest()
+
+    def get(self, key: str):
+        """
+        cached prediction for the key or None. hits and misses are counted by the caller, since lookups may
+        run in loader processes
+        """
+
+        row = self.conn.execute("SELECT value FROM predictions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("UPDATE predictions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, prediction: dict) -> None:
+        value = json.dumps(prediction, ensure_ascii=False)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO predictions (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, value, len(value), time.time()),
+        )
+        self.puts += 1
+        if self.puts % 256 == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        drop least recently used predictions until the cache is back under 90% of max_bytes, returns how many
+        """
+
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+
+        removed = 0
+        target = total - int(0.9 * self.max_bytes)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            freed = 0
+            while freed < target:
+                rows = self.conn.execute("SELECT key, size FROM predictions ORDER BY last_used LIMIT 1000").fetchall()
+                if not rows:
+                    break
+                for key, size in rows:
+                    if freed >= target:
+                        break
+                    self.conn.execute("DELETE FROM predictions WHERE key = ?", (key,))
+                    freed += size
+                    removed += 1
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return removed
+
+    def stats(self) -> dict:
+        entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM predictions").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "entries": entries,
+            "bytes": size,
+        }
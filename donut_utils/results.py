@@ -0,0 +1,102 @@
+import json
+import os
+import time
+
+
+class ResultWriter:
+    """
+    appends predictions to a JSONL results file as soon as they are done, and fsyncs it every fsync_interval
+    seconds so a crash loses at most that much work
+    """
+
+    def __init__(self, path: str, resume=False, fsync_interval=30.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        if resume and os.path.exists(path):
+            _drop_partial_line(path)
+            self.f = open(path, "a", encoding="utf-8")
+        else:
+            self.f = open(path, "w", encoding="utf-8")
+        self.last_sync = time.time()
+
+    def write(self, prediction: dict) -> None:
+        self.f.write(json.dumps(prediction, ensure_ascii=False) + "\n")
+        if time.time() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.last_sync = time.time()
+
+    def close(self) -> None:
+        self.sync()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _drop_partial_line(path: str) -> None:
+    """
+    cut a line left half written by a crash off the end of the file
+    """
+
+    with open(path, "r+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+
+        ## walk back to the last complete line
+        pos = size
+        while pos > 0:
+            step = min(1 << 16, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            nl = chunk.rfind(b"\n")
+            if nl != -1:
+                f.truncate(pos - step + nl + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+
+def iter_results(path: str):
+    """
+    predictions of a JSONL results file, a half written last line is skipped
+    """
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
+def load_done(path: str) -> set:
+    """
+    file names of the images that already have a prediction in the results file
+    """
+
+    if not os.path.exists(path):
+        return set()
+    return {p["file_name"] for p in iter_results(path)}
+
+
+def read_results(path: str) -> list:
+    """
+    all predictions of a results file, in the (sorted) input order of inferencing.py
+    """
+
+    return sorted(iter_results(path), key=lambda p: p["file_name"])
@@ -3,8 +3,17 @@ import os
 import random
 import numpy as np
 
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFilter
 
+@lru_cache(maxsize=1)
+def list_pictures():
+    """
+        List the pictures folder once per process instead of once per sample
+    """
+
+    return os.listdir('./pictures')
+
 class BackgroundGenerator(object):
     @classmethod
     def gaussian_noise(cls, height, width):
@@ -12,7 +21,9 @@ class BackgroundGenerator(object):
             Create a background with Gaussian noise (to mimic paper)
         """
 
-        image = Image.effect_noise((width, height), 60).convert('RGB')
+        # Same distribution as Image.effect_noise((width, height), 60), drawn from numpy so it follows the sample seed
+        noise = np.clip(np.random.normal(128, 60, (height, width)), 0, 255).astype(np.uint8)
+        image = Image.fromarray(noise, 'L').convert('RGB')
         white = Image.new("RGB", (width, height), (250, 250, np.random.random_integers(150, 250)))
 
         image = Image.blend(image, white, np.random.rand() / 4.0 + 0.75)
@@ -59,7 +70,7 @@ class BackgroundGenerator(object):
             Create a background with a picture
         """
 
-        pictures = os.listdir('./pictures')
+        pictures = list_pictures()
 
         if len(pictures) > 0:
             picture = Image.open('./pictures/' + pictures[random.randint(0, len(pictures) - 1)])
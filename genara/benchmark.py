@@ -0,0 +1,152 @@
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+import numpy as np
+
+from multiprocessing import Pool
+
+from font_coverage import load_fonts
+from sample_stream import DEFAULT_SETTINGS, SampleRenderer
+from seeding import FONT, sample_seeds, seed_sample
+from string_generator import create_strings_from_dict, load_dict
+
+STAGES = ['text', 'skew', 'distortion', 'resize', 'background', 'composite', 'blur', 'encode']
+
+def parse_arguments():
+    """
+        Parse the command line arguments of the benchmark.
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the genara pipeline on a fixed, seeded workload.')
+    parser.add_argument("-l", "--language", type=str, nargs="?", help="The language of the dictionary and fonts", default="ara")
+    parser.add_argument("-c", "--count", type=int, nargs="?", help="The number of samples rendered per run", default=500)
+    parser.add_argument("-w", "--length", type=int, nargs="?", help="The maximum number of words per sample", default=1)
+    parser.add_argument("-sd", "--seed", type=int, nargs="?", help="The run seed of the workload", default=0)
+    parser.add_argument("-f", "--format", type=int, nargs="?", help="The height of the produced images", default=DEFAULT_SETTINGS['size'])
+    parser.add_argument("-b", "--background", type=int, nargs="?", help="0: Gaussian Noise, 1: Plain white, 2: Quasicrystal, 3: Pictures", default=0)
+    parser.add_argument("-d", "--distortion", type=int, nargs="?", help="0: None, 1: Sine wave, 2: Cosine wave, 3: Random", default=0)
+    parser.add_argument("-do", "--distortion_orientation", type=int, nargs="?", help="0: Vertical, 1: Horizontal, 2: Both", default=0)
+    parser.add_argument("--fused", action="store_true", help="Use the fused skew, distortion, composite and blur stages", default=False)
+    parser.add_argument("-e", "--extension", type=str, nargs="?", help="The image format used for the encode stage", default="jpg")
+    parser.add_argument("-p", "--processes", type=str, nargs="?", help="Comma separated process counts to measure scaling with", default="1,2,4")
+    parser.add_argument("-cs", "--chunk_size", type=int, nargs="?", help="The number of samples per worker task", default=25)
+    parser.add_argument("-o", "--output", type=str, nargs="?", help="The JSON file the results are written to", default="benchmark.json")
+    parser.add_argument("--tag", type=str, nargs="?", help="Free form label stored with the results, e.g. the font set", default="")
+
+    return parser.parse_args()
+
+def bench_chunk(t):
+    """
+        Render and encode one chunk of the workload, return its stage timings and the peak RSS of the worker
+    """
+
+    first, strings, fonts, seed, settings, extension = t
+    args = [settings[k] for k in DEFAULT_SETTINGS]
+    font_choices = (sample_seeds(seed, np.arange(first, first + len(strings)), FONT) % np.uint64(len(fonts))).tolist()
+    image_format = 'JPEG' if extension in ('jpg', 'jpeg') else extension.upper()
+
+    timings = {}
+    for i, text in enumerate(strings):
+        seed_sample(seed, first + i)
+        image = SampleRenderer.render(text, fonts[font_choices[i]], *args, timings=timings)
+        t0 = time.perf_counter()
+        image.save(io.BytesIO(), format=image_format)
+        timings['encode'] = timings.get('encode', 0.0) + time.perf_counter() - t0
+
+    # ru_maxrss is in kilobytes on Linux
+    return timings, len(strings), os.getpid(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_workload(processes, strings, fonts, seed, settings, extension, chunk_size):
+    """
+        Render the whole workload with the given number of processes
+    """
+
+    chunks = [
+        (start, strings[start:start + chunk_size], fonts, seed, settings, extension)
+        for start in range(0, len(strings), chunk_size)
+    ]
+
+    timings = {}
+    worker_rss = {}
+    t0 = time.perf_counter()
+    with Pool(processes) as p:
+        for chunk_timings, _, pid, rss in p.imap_unordered(bench_chunk, chunks):
+            for stage, seconds in chunk_timings.items():
+                timings[stage] = timings.get(stage, 0.0) + seconds
+            worker_rss[pid] = max(rss, worker_rss.get(pid, 0))
+    wall = time.perf_counter() - t0
+
+    total = sum(timings.values())
+    return {
+        'processes': processes,
+        'seconds': wall,
+        'samples_per_sec': len(strings) / wall,
+        'stages': {
+            stage: {
+                'seconds': timings.get(stage, 0.0),
+                'ms_per_sample': 1000 * timings.get(stage, 0.0) / len(strings),
+                'share': timings.get(stage, 0.0) / total if total else 0.0,
+            }
+            for stage in STAGES
+        },
+        'worker_max_rss_mb': sorted(worker_rss.values()),
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """
+        Description: Run the benchmark and write the results to JSON
+    """
+
+    args = parse_arguments()
+
+    settings = dict(
+        DEFAULT_SETTINGS,
+        size=args.format,
+        background_type=args.background,
+        distorsion_type=args.distortion,
+        distorsion_orientation=args.distortion_orientation,
+        lang=args.language,
+        fused=args.fused,
+    )
+    fonts = load_fonts(args.language)
+    strings = create_strings_from_dict(args.length, True, args.count, load_dict(args.language), args.language, args.seed)
+
+    runs = []
+    for processes in [int(p) for p in args.processes.split(',')]:
+        run = run_workload(processes, strings, fonts, args.seed, settings, args.extension, args.chunk_size)
+        run['speedup'] = runs[0]['seconds'] / run['seconds'] if runs else 1.0
+        runs.append(run)
+        print("{:>3} processes: {:8.1f} samples/sec".format(processes, run['samples_per_sec']))
+
+    for stage, s in runs[0]['stages'].items():
+        print("{:>12}: {:8.2f} ms/sample {:6.1%}".format(stage, s['ms_per_sample'], s['share']))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'tag': args.tag,
+            'commit': git_commit(),
+            'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+            'workload': {
+                'count': args.count,
+                'length': args.length,
+                'seed': args.seed,
+                'extension': args.extension,
+                'fonts': fonts,
+                'settings': settings,
+            },
+            'runs': runs,
+        }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import bisect
+import json
+import os
+
+class Checkpoint(object):
+    """
+        Record of the completed index ranges of a run over [start, end) and of the
+        metadata shard offsets that belong to them
+    """
+
+    def __init__(self, path, seed, start, end):
+        self.path = path
+        self.seed = seed
+        self.start = start
+        self.end = end
+        self.completed = []
+        self.offsets = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            d = json.load(f)
+        checkpoint = cls(path, d['seed'], d['start'], d['end'])
+        checkpoint.completed = [tuple(r) for r in d['completed']]
+        checkpoint.offsets = d['offsets']
+        return checkpoint
+
+    def save(self):
+        """
+            Write the checkpoint atomically, a crash while saving keeps the previous one
+        """
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'seed': self.seed,
+                'start': self.start,
+                'end': self.end,
+                'completed': self.completed,
+                'offsets': self.offsets,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def add(self, first, last, offsets):
+        """
+            Mark [first, last) as completed. offsets maps each shard written by the
+            batch to its size right after the batch was appended
+        """
+
+        i = bisect.bisect_left(self.completed, (first, last))
+        self.completed.insert(i, (first, last))
+
+        # Merge with the neighbouring ranges
+        merged = []
+        for r in self.completed[max(0, i - 1):i + 2]:
+            if merged and r[0] <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], r[1]))
+            else:
+                merged.append(r)
+        self.completed[max(0, i - 1):i + 2] = merged
+
+        for path, offset in offsets.items():
+            self.offsets[path] = max(offset, self.offsets.get(path, 0))
+
+    def completed_count(self):
+        return sum(last - first for first, last in self.completed)
+
+    def pending(self):
+        """
+            Index ranges of [start, end) that still have to be generated
+        """
+
+        ranges = []
+        current = self.start
+        for first, last in self.completed:
+            if first > current:
+                ranges.append((current, first))
+            current = max(current, last)
+        if current < self.end:
+            ranges.append((current, self.end))
+        return ranges
+
+    def restore_shards(self, shards):
+        """
+            Cut the given metadata shards back to their checkpointed size. Rows past it
+            belong to batches that were not checkpointed and will be generated again
+        """
+
+        for path in shards:
+            if path in self.offsets:
+                with open(path, 'r+b') as f:
+                    f.truncate(self.offsets[path])
+            else:
+                os.remove(path)
@@ -1,7 +1,16 @@
 import random
 
+from functools import lru_cache
 from PIL import Image, ImageColor, ImageFont, ImageDraw, features
 
+@lru_cache(maxsize=256)
+def load_font(font, font_size):
+    """
+        Load a truetype font once per process, workers keep it warm across their batches
+    """
+
+    return ImageFont.truetype(font=font, size=font_size)
+
 class ComputerTextGenerator(object):
     @classmethod
     def generate(cls, text, font, text_color, font_size, orientation, space_width, lang):
@@ -14,7 +23,7 @@ class ComputerTextGenerator(object):
     
     @classmethod
     def __generate_horizontal_text(cls, text, font, text_color, font_size, space_width, lang):
-        image_font = ImageFont.truetype(font=font, size=font_size)
+        image_font = load_font(font, font_size)
         # print(font)
         words = text.split(' ')
         space_width = image_font.getsize(' ')[0] * space_width
@@ -48,7 +57,7 @@ class ComputerTextGenerator(object):
 
     @classmethod
     def __generate_vertical_text(cls, text, font, text_color, font_size, space_width):
-        image_font = ImageFont.truetype(font=font, size=font_size)
+        image_font = load_font(font, font_size)
         
         space_height = int(image_font.getsize(' ')[1] * space_width)
 
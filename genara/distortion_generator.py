@@ -51,15 +51,29 @@ class DistortionGenerator(object):
 
         return Image.fromarray(np.uint8(new_img_arr_copy if horizontal and vertical else new_img_arr)).convert('RGBA')
 
+    @classmethod
+    def offset_function(cls, distorsion_type, height):
+        """
+            Maximum offset and offset function of a distortion type (1: sine, 2: cosine, 3: random)
+            for an image of the given height
+        """
+
+        if distorsion_type == 1:
+            max_offset = int(height ** 0.5)
+            return max_offset, (lambda x: int(math.sin(math.radians(x)) * max_offset))
+        if distorsion_type == 2:
+            max_offset = int(height ** 0.5)
+            return max_offset, (lambda x: int(math.cos(math.radians(x)) * max_offset))
+        max_offset = int(height ** 0.4)
+        return max_offset, (lambda x: np.random.randint(0, max_offset))
+
     @classmethod
     def sin(cls, image, vertical=False, horizontal=False):
         """
             Apply a sine distortion on one or both of the specified axis
         """
 
-        max_offset = int(image.height ** 0.5)
-
-        return cls.apply_func_distortion(image, vertical, horizontal, max_offset, (lambda x: int(math.sin(math.radians(x)) * max_offset)))
+        return cls.apply_func_distortion(image, vertical, horizontal, *cls.offset_function(1, image.height))
 
     @classmethod
     def cos(cls, image, vertical=False, horizontal=False):
@@ -67,9 +81,7 @@ class DistortionGenerator(object):
             Apply a cosine distortion on one or both of the specified axis
         """
 
-        max_offset = int(image.height ** 0.5)
-
-        return cls.apply_func_distortion(image, vertical, horizontal, max_offset, (lambda x: int(math.cos(math.radians(x)) * max_offset)))
+        return cls.apply_func_distortion(image, vertical, horizontal, *cls.offset_function(2, image.height))
 
     @classmethod
     def random(cls, image, vertical=False, horizontal=False):
@@ -77,6 +89,97 @@ class DistortionGenerator(object):
             Apply a random distortion on one or both of the specified axis
         """
 
-        max_offset = int(image.height ** 0.4)
+        return cls.apply_func_distortion(image, vertical, horizontal, *cls.offset_function(3, image.height))
+
+    @classmethod
+    def expanded_rotation(cls, width, height, angle):
+        """
+            Size of an image of the given size once rotated by angle degrees with expand=1,
+            and the affine matrix from output to input pixel coordinates, computed as Image.rotate does
+        """
+
+        angle = -math.radians(angle)
+        matrix = [
+            round(math.cos(angle), 15), round(math.sin(angle), 15), 0.0,
+            round(-math.sin(angle), 15), round(math.cos(angle), 15), 0.0,
+        ]
+
+        def transform(x, y):
+            a, b, c, d, e, f = matrix
+            return a * x + b * y + c, d * x + e * y + f
+
+        matrix[2], matrix[5] = transform(-width / 2.0, -height / 2.0)
+        matrix[2] += width / 2.0
+        matrix[5] += height / 2.0
+
+        xx, yy = zip(*[transform(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))])
+        new_width = math.ceil(max(xx)) - math.floor(min(xx))
+        new_height = math.ceil(max(yy)) - math.floor(min(yy))
+        matrix[2], matrix[5] = transform(-(new_width - width) / 2.0, -(new_height - height) / 2.0)
+
+        return new_width, new_height, matrix
+
+    @classmethod
+    def skew_and_distort(cls, image, angle, distorsion_type=0, vertical=False, horizontal=False):
+        """
+            Same result as image.rotate(angle, expand=1) followed by the distortion of the given type,
+            but done as one nearest neighbour remap of the RGBA text image. The rotation map comes from
+            rotating an image of pixel indices, the distortion offsets are applied to that map, and the
+            pixels are gathered once, so the rotated image and the float64 copies of apply_func_distortion
+            are never made. Offsets are drawn in the same order as there
+        """
+
+        image = image if image.mode == 'RGBA' else image.convert('RGBA')
+
+        # Without distortion there is nothing to fuse, Image.rotate is a single pass already
+        if distorsion_type == 0 or not (vertical or horizontal):
+            return image.rotate(angle, expand=1) if angle else image
+
+        width, height = image.size
+
+        # Index + 1 of the source pixel of every rotated pixel, 0 where rotate leaves it transparent,
+        # with a border of zeros so that clipped coordinates land on a transparent pixel
+        indices = np.arange(1, width * height + 1, dtype=np.int32).reshape(height, width)
+        if angle:
+            indices = np.asarray(Image.fromarray(indices, 'I').rotate(angle, expand=1))
+        rotated_height, rotated_width = indices.shape
+        rotation = np.zeros((rotated_height + 2, rotated_width + 2), dtype=np.int32)
+        rotation[1:-1, 1:-1] = indices
+
+        max_offset, func = cls.offset_function(distorsion_type, rotated_height)
+        vertical_offsets = [func(i) for i in range(rotated_width)]
+        horizontal_offsets = [
+            func(i)
+            for i in range(
+                rotated_height + (
+                    (max(vertical_offsets) - min(min(vertical_offsets), 0)) if vertical else 0
+                )
+            )
+        ]
+
+        out_height = rotated_height + (2 * max_offset if vertical else 0)
+        out_width = rotated_width + (2 * max_offset if horizontal else 0)
+
+        # Undo the horizontal shift of every row, rows past the offsets stay empty
+        x = np.arange(out_width, dtype=np.int32)[None, :]
+        if horizontal:
+            shift = np.full(out_height, out_width + max_offset, dtype=np.int32)
+            rows = min(out_height, len(horizontal_offsets))
+            shift[:rows] = horizontal_offsets[:rows]
+            x = x - (max_offset + shift[:, None])
+        x = np.clip(x, -1, rotated_width) + 1
+
+        # Then the vertical shift of every column
+        y = np.arange(out_height, dtype=np.int32)[:, None]
+        if vertical:
+            column_offsets = np.zeros(rotated_width + 2, dtype=np.int32)
+            column_offsets[1:-1] = vertical_offsets
+            y = y - (max_offset + column_offsets[x])
+        y = np.clip(y, -1, rotated_height) + 1
+
+        source = np.zeros(width * height + 1, dtype=np.uint32)
+        source[1:] = np.asarray(image).view(np.uint32).ravel()
+        out = source[rotation[y, x]]
 
-        return cls.apply_func_distortion(image, vertical, horizontal, max_offset, (lambda x: np.random.randint(0, max_offset)))
+        # The RGBA image uses the gathered buffer as it is
+        return Image.frombuffer('RGBA', (out_width, out_height), out, 'raw', 'RGBA', 0, 1)
@@ -0,0 +1,232 @@
+import json
+import os
+import unicodedata
+
+from collections import Counter
+
+# Bump when the cached entries change meaning, older caches are rebuilt
+COVERAGE_VERSION = 1
+
+def load_fonts(lang):
+    """
+        Load all fonts in the fonts directories
+    """
+
+    # Sorted so that font choices derived from the seed are the same on every machine
+    if lang == 'cn':
+        return [os.path.join('fonts/cn', font) for font in sorted(os.listdir('fonts/cn'))]
+    else:
+        return [os.path.join('fonts/' + lang, font) for font in sorted(os.listdir('fonts/' + lang))]
+
+def _needs_arabic_shaping(codepoint):
+    """
+        Arabic, Arabic Supplement and Arabic Extended-A letters, rendered through the GSUB
+        contextual forms and ligatures of the font
+    """
+
+    return 0x0600 <= codepoint <= 0x06FF or 0x0750 <= codepoint <= 0x077F or 0x08A0 <= codepoint <= 0x08FF
+
+def _ignored(char):
+    """
+        Characters that are not drawn from a glyph: spaces, controls and format characters (ZWJ, RLM...)
+    """
+
+    return char.isspace() or unicodedata.category(char) in ('Cc', 'Cf')
+
+def _ranges(codepoints):
+    """
+        Sorted codepoints as [first, last] ranges, so the cache stays small
+    """
+
+    ranges = []
+    for c in sorted(codepoints):
+        if ranges and ranges[-1][1] == c - 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return ranges
+
+def _expand(ranges):
+    return {c for first, last in ranges for c in range(first, last + 1)}
+
+def font_coverage(path):
+    """
+        Codepoints mapped by the cmap of a font and whether its GSUB table has Arabic shaping
+        (contextual forms and the lam-alef ligatures). Needs fontTools
+    """
+
+    from fontTools.ttLib import TTFont
+
+    with TTFont(path, lazy=True, fontNumber=0) as font:
+        codepoints = set(font.getBestCmap() or {})
+        shaping = False
+        if 'GSUB' in font and font['GSUB'].table.ScriptList is not None:
+            shaping = any(record.ScriptTag == 'arab' for record in font['GSUB'].table.ScriptList.ScriptRecord)
+    return codepoints, shaping
+
+def load_coverage(fonts, cache_path):
+    """
+        Coverage of every font as {path: (codepoints, shaping)}. Fonts are only read when they
+        are missing from the cache at cache_path or changed since, the cache is then rewritten
+    """
+
+    cached = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf8') as f:
+            d = json.load(f)
+        if d.get('version') == COVERAGE_VERSION:
+            cached = d['fonts']
+
+    entries = {}
+    changed = False
+    for font in fonts:
+        name = os.path.basename(font)
+        stat = os.stat(font)
+        entry = cached.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            codepoints, shaping = font_coverage(font)
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'shaping': shaping, 'codepoints': _ranges(codepoints)}
+            changed = True
+        entries[name] = entry
+
+    if changed or set(entries) != set(cached):
+        tmp = cache_path + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            json.dump({'version': COVERAGE_VERSION, 'fonts': entries}, f)
+        os.replace(tmp, cache_path)
+
+    return {
+        font: (_expand(entries[os.path.basename(font)]['codepoints']), entries[os.path.basename(font)]['shaping'])
+        for font in fonts
+    }
+
+def coverage_cache_path(lang):
+    """
+        Cache of the coverage of the fonts of a language, next to their folder
+    """
+
+    return os.path.join('fonts', lang + '.coverage.json')
+
+class CoverageIndex(object):
+    """
+        Inverted index from every codepoint to the set of fonts covering it, as a bit mask
+        over the font list. The fonts able to render a text are the AND of the masks of its
+        characters, a handful of integer operations per distinct character
+    """
+
+    def __init__(self, fonts, coverage):
+        self.fonts = fonts
+        self.all = (1 << len(fonts)) - 1
+        self.by_codepoint = {}
+        self.shaping = 0
+        for i, font in enumerate(fonts):
+            codepoints, shaping = coverage[font]
+            bit = 1 << i
+            for c in codepoints:
+                self.by_codepoint[c] = self.by_codepoint.get(c, 0) | bit
+            if shaping:
+                self.shaping |= bit
+        self._masks = {}
+        self._members = {}
+
+    @classmethod
+    def for_language(cls, fonts, lang):
+        return cls(fonts, load_coverage(fonts, coverage_cache_path(lang)))
+
+    def mask(self, text):
+        """
+            Bit mask of the fonts covering every character of text
+        """
+
+        mask = self._masks.get(text)
+        if mask is None:
+            mask = self.all
+            for char in set(text):
+                if _ignored(char):
+                    continue
+                c = ord(char)
+                mask &= self.by_codepoint.get(c, 0)
+                if _needs_arabic_shaping(c):
+                    mask &= self.shaping
+            self._masks[text] = mask
+        return mask
+
+    def members(self, mask):
+        """
+            Indices of the fonts in a mask, in font list order
+        """
+
+        members = self._members.get(mask)
+        if members is None:
+            members = [i for i in range(len(self.fonts)) if mask >> i & 1]
+            self._members[mask] = members
+        return members
+
+    def choose(self, strings, seeds):
+        """
+            Font of every string among the fonts covering it, picked by its seed like an
+            unconstrained choice would be (seed modulo the number of candidates), so the choice
+            does not change when every font covers the string. None when no font covers it
+        """
+
+        choices = []
+        for text, seed in zip(strings, seeds):
+            members = self.members(self.mask(text))
+            choices.append(self.fonts[members[seed % len(members)]] if members else None)
+        return choices
+
+    def report(self, strings, top=20):
+        """
+            Statistics of the rejected font/text combinations: how many texts lose some or all
+            of their fonts, which fonts are rejected the most and which characters no font covers
+        """
+
+        counts = Counter(strings)
+        rejected_by_font = Counter()
+        missing_everywhere = Counter()
+        missing_by_font = {font: Counter() for font in self.fonts}
+        constrained = uncovered = rejected = 0
+
+        for text, count in counts.items():
+            mask = self.mask(text)
+            if mask == self.all:
+                continue
+            if mask == 0:
+                uncovered += count
+            else:
+                constrained += count
+            for i in self.members(self.all & ~mask):
+                rejected += count
+                rejected_by_font[self.fonts[i]] += count
+            for char in set(text):
+                if _ignored(char):
+                    continue
+                fonts = self.by_codepoint.get(ord(char), 0)
+                if fonts == 0:
+                    missing_everywhere[char] += count
+                for i in self.members(self.all & ~fonts):
+                    missing_by_font[self.fonts[i]][char] += count
+
+        samples = len(strings)
+        return {
+            'fonts': len(self.fonts),
+            'samples': samples,
+            'constrained_samples': constrained,
+            'uncovered_samples': uncovered,
+            'rejected_combinations': rejected,
+            'rejected_fraction': rejected / (samples * len(self.fonts)) if samples and self.fonts else 0.0,
+            'fonts_without_arabic_shaping': [
+                os.path.basename(font) for i, font in enumerate(self.fonts) if not self.shaping >> i & 1
+            ],
+            'rejected_by_font': {
+                os.path.basename(font): {
+                    'samples': n,
+                    'missing': [char for char, _ in missing_by_font[font].most_common(top)],
+                }
+                for font, n in rejected_by_font.most_common()
+            },
+            'missing_everywhere': [
+                {'char': char, 'codepoint': 'U+{:04X}'.format(ord(char)), 'samples': n}
+                for char, n in missing_everywhere.most_common(top)
+            ],
+        }
@@ -1,37 +1,25 @@
-import os
-import jsonlines
-import numpy as np
-import json
+import argparse
 
-splits = [0.8, 0.1, 0.1]
-folders = ['train', 'test', 'validation']
+from shard_writer import finalize
 
-files = [[], [], []]
+## run.py already writes every image into <output_dir>/<split>/ together with
+## per-worker metadata shards, this only merges the shards of each split into
+## its metadata.jsonl (e.g. after an interrupted run)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the metadata shards of a generated dataset.')
+    parser.add_argument(
+        "output_dir",
+        type=str,
+        nargs="?",
+        help="The output directory of run.py",
+        default="out/",
+    )
+    parser.add_argument(
+        "--manifest",
+        action="store_true",
+        help="Also write <output_dir>/manifest.parquet. Needs pyarrow",
+        default=False
+    )
+    args = parser.parse_args()
 
-## get file data
-with jsonlines.open(f"out/metadata.jsonl") as reader:
-    for d in reader:
-        s = np.random.choice(3, p=splits)
-        files[s].append(d)
-        
-        file = d["file_name"]
-
-        try:
-            os.rename(f"out/{file}", f"genara_data/{folders[s]}/{file}")
-        except:
-            print(file)
-
-with open("genara_data/train/metadata.jsonl", 'w') as f:
-    for d in files[0]:
-        f.write(json.dumps(d))
-        f.write('\n')
-        
-with open("genara_data/test/metadata.jsonl", 'w') as f:
-    for d in files[1]:
-        f.write(json.dumps(d))
-        f.write('\n')
-        
-with open("genara_data/validation/metadata.jsonl", 'w') as f:
-    for d in files[2]:
-        f.write(json.dumps(d))
-        f.write('\n')
+    finalize(args.output_dir, args.manifest)
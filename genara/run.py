@@ -1,20 +1,39 @@
 import argparse
+import json
 import os, errno
-import random
+import signal
+import socket
+import threading
+import time
 
-from tqdm import tqdm
-from string_generator import (
-    create_strings_from_dict,
-    create_strings_from_file,
+# numpy, the renderer and everything else a run needs are only imported once the
+# arguments are parsed, so --help and scripts importing this module do not pay for them
+from checkpoint import Checkpoint
+from shard_writer import (
+    assign_split,
+    finalize,
+    folders,
+    make_split_dirs,
+    metadata_row,
+    set_shard_prefix,
+    shard_paths,
+    write_shard,
 )
-from data_generator import FakeTextDataGenerator
-from multiprocessing import Pool
 
 def valid_range(s):
     if len(s.split(',')) > 2:
         raise argparse.ArgumentError("The given range is invalid, please use ?,? format.")
     return tuple([int(i) for i in s.split(',')])
 
+def valid_shard(s):
+    try:
+        i, n = [int(v) for v in s.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("The given shard is invalid, please use i/N format.")
+    if n < 1 or not 0 <= i < n:
+        raise argparse.ArgumentTypeError("The shard index should be between 0 and N - 1.")
+    return i, n
+
 def parse_arguments():
     """
         Parse the command line arguments of the program.
@@ -215,28 +234,179 @@ def parse_arguments():
         help="Define the width of the spaces between words. 2.0 means twice the normal space width",
         default=0.64
     )
+    parser.add_argument(
+        "-bs",
+        "--batch_size",
+        type=int,
+        nargs="?",
+        help="Define how many samples each worker renders per task. Larger batches amortize pickling and font loading",
+        default=64
+    )
+    parser.add_argument(
+        "-sd",
+        "--seed",
+        type=int,
+        nargs="?",
+        help="Define the run seed. Every sample is derived from the run seed and its index only, so any sample can be regenerated. Random if not set",
+        default=None
+    )
+    parser.add_argument(
+        "--start",
+        type=int,
+        nargs="?",
+        help="Define the index of the first sample to generate",
+        default=0
+    )
+    parser.add_argument(
+        "--end",
+        type=int,
+        nargs="?",
+        help="Define the index after the last sample to generate. Defaults to --count",
+        default=None
+    )
+    parser.add_argument(
+        "--shard",
+        type=valid_shard,
+        nargs="?",
+        help="Only generate shard i of N (i/N format) of the [start, end) range, to split one run across machines",
+        default=None
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from its checkpoint in the output directory, skipping the completed samples",
+        default=False
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=float,
+        nargs="?",
+        help="Define how often (in seconds) the completed index ranges are checkpointed",
+        default=60
+    )
+    parser.add_argument(
+        "--manifest",
+        action="store_true",
+        help="Also write a Parquet manifest of every sample (file, split, index, ground truth) to the output directory. Needs pyarrow",
+        default=False
+    )
+    parser.add_argument(
+        "--font_coverage",
+        action="store_true",
+        help="Only render a sample with fonts covering all of its characters (and Arabic shaping), samples no font covers are skipped. The coverage of the fonts is cached in fonts/<lang>.coverage.json. Needs fontTools",
+        default=False
+    )
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        nargs="?",
+        help="Define a Prometheus text file the live sample count, samples/sec, queue depth, worker memory and ETA are written to",
+        default=None
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        nargs="?",
+        help="Define a local port the same metrics are served on",
+        default=None
+    )
 
     return parser.parse_args()
 
-def load_dict(lang):
+def generate_batch(t):
     """
-        Read the dictionnary file and returns all words in it.
+        Render a block of samples inside one worker. Takes (indices, strings, fonts, seed, config)
+        where config is the tuple of generation settings shared by the whole block.
+        The random generators are reseeded from the run seed and the index before each sample.
+        Each image is written straight into the folder of its split and the block's
+        metadata is appended to this worker's shards.
+        Returns the index range of the block, the number of samples rendered (fewer than the
+        range with --font_coverage) and the shard offsets right after it, so the main process
+        can report progress and checkpoint per batch.
     """
 
-    lang_dict = []
-    with open(os.path.join('dicts', lang) + ".txt", 'r', encoding="utf8", errors='ignore') as d:
-        lang_dict = d.readlines()
-    return lang_dict
+    from data_generator import FakeTextDataGenerator
+    from seeding import seed_sample
 
-def load_fonts(lang):
+    indices, strings, fonts, seed, config = t
+    output_dir, extension = config[0], config[2]
+    rows = []
+    for index, text, font in zip(indices, strings, fonts):
+        # No font covers the text, see --font_coverage
+        if font is None:
+            continue
+        seed_sample(seed, index)
+        s = assign_split(index)
+        FakeTextDataGenerator.generate_from_tuple(
+            (index, text, font, os.path.join(output_dir, folders[s])) + config[1:]
+        )
+        rows.append((s, metadata_row(str(index) + "." + extension, text)))
+    offsets = write_shard(output_dir, rows)
+    return indices[0], indices[-1] + 1, len(rows), offsets
+
+def init_worker(prefix):
     """
-        Load all fonts in the fonts directories
+        Workers leave SIGINT to the main process, which drains them before stopping
     """
 
-    if lang == 'cn':
-        return [os.path.join('fonts/cn', font) for font in os.listdir('fonts/cn')]
-    else:
-        return [os.path.join('fonts/' + lang, font) for font in os.listdir('fonts/' + lang)]
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_shard_prefix(prefix)
+
+def make_batches(ranges, first, strings, fonts, seed, config, batch_size):
+    """
+        Split the index ranges still to generate into blocks of batch_size, each
+        carrying one copy of the shared config. strings and fonts start at index first
+    """
+
+    for range_start, range_end in ranges:
+        for start in range(range_start, range_end, batch_size):
+            end = min(start + batch_size, range_end)
+            yield (
+                list(range(start, end)),
+                strings[start - first:end - first],
+                fonts[start - first:end - first],
+                seed,
+                config
+            )
+
+def dispatch(p, batches, max_in_flight, stop, metrics=None):
+    """
+        Feed the batches to the pool with at most max_in_flight of them in progress.
+        Once stop is set no new batch is fed, the ones in flight are drained.
+        The number of batches in flight goes to the queue_depth gauge of metrics
+    """
+
+    slots = threading.Semaphore(max_in_flight)
+    counts = {'fed': 0, 'done': 0}
+
+    def feed():
+        for batch in batches:
+            slots.acquire()
+            if stop.is_set():
+                return
+            counts['fed'] += 1
+            if metrics is not None:
+                metrics.set('queue_depth', counts['fed'] - counts['done'], queue='batches')
+            yield batch
+
+    for result in p.imap_unordered(generate_batch, feed()):
+        slots.release()
+        counts['done'] += 1
+        if metrics is not None:
+            metrics.set('queue_depth', counts['fed'] - counts['done'], queue='batches')
+        yield result
+
+def sample_range(args):
+    """
+        Indices [start, end) generated by this process, after applying --shard
+    """
+
+    start = args.start
+    end = args.count if args.end is None else args.end
+    if args.shard is not None:
+        i, n = args.shard
+        start, end = start + (end - start) * i // n, start + (end - start) * (i + 1) // n
+    return start, max(start, end)
 
 def main():
     """
@@ -245,12 +415,23 @@ def main():
 
     # Argument parsing
     args = parse_arguments()
+
+    import numpy as np
+    from multiprocessing import Pool
+    from tqdm import tqdm
+
+    from font_coverage import CoverageIndex, load_fonts
+    from metrics import Metrics
+    from seeding import FONT, new_run_seed, sample_seeds
+    from string_generator import create_strings_from_dict, create_strings_from_file, load_dict
+
     # Create the directory if it does not exist.
     try:
         os.makedirs(args.output_dir)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
+    make_split_dirs(args.output_dir)
 
     if not args.input_file:
         # Creating word list
@@ -259,44 +440,107 @@ def main():
     # Create font (path) list
     fonts = load_fonts(args.language)
 
+    start, end = sample_range(args)
+
+    checkpoint_path = os.path.join(args.output_dir, 'checkpoint-{}-{}.json'.format(start, end))
+    prefix = '{}-{}-{}'.format(socket.gethostname(), start, end)
+    if args.resume and os.path.exists(checkpoint_path):
+        checkpoint = Checkpoint.load(checkpoint_path)
+        if args.seed is None:
+            args.seed = checkpoint.seed
+        elif args.seed != checkpoint.seed:
+            raise ValueError("The checkpoint was written with seed {}, resume it with the same seed".format(checkpoint.seed))
+        checkpoint.restore_shards(shard_paths(args.output_dir, prefix))
+    else:
+        if args.seed is None:
+            args.seed = new_run_seed()
+        checkpoint = Checkpoint(checkpoint_path, args.seed, start, end)
+        # Shards left by an earlier run over the same range would be merged with this one
+        checkpoint.restore_shards(shard_paths(args.output_dir, prefix))
+    print("Run seed: {}".format(args.seed))
+
     # Creating synthetic sentences (or word)
     strings = []
 
     if args.input_file != '':
-        strings = create_strings_from_file(args.input_file, args.count, args.length)
+        strings = create_strings_from_file(args.input_file, end - start, args.length, args.seed, start)
     else:
-        strings = create_strings_from_dict(args.length, args.random, args.count, lang_dict, args.language)
+        strings = create_strings_from_dict(args.length, args.random, end - start, lang_dict, args.language, args.seed, start)
 
 
     string_count = len(strings)
 
-    p = Pool(args.thread_count)
-    for _ in tqdm(p.imap_unordered(
-        FakeTextDataGenerator.generate_from_tuple,
-        zip(
-            [i for i in range(0, string_count)],
-            strings,
-            [fonts[random.randrange(0, len(fonts))] for _ in range(0, string_count)],
-            [args.output_dir] * string_count,
-            [args.format] * string_count,
-            [args.extension] * string_count,
-            [args.skew_angle] * string_count,
-            [args.random_skew] * string_count,
-            [args.blur] * string_count,
-            [args.random_blur] * string_count,
-            [args.background] * string_count,
-            [args.distortion] * string_count,
-            [args.distortion_orientation] * string_count,
-            [args.width] * string_count,
-            [args.alignment] * string_count,
-            [args.text_color] * string_count,
-            [args.orientation] * string_count,
-            [args.space_width] * string_count,
-            [args.language] * string_count
-        )
-    ), total=args.count):
-        pass
-    p.terminate()
+    # Settings shared by every sample, sent once per batch instead of once per sample
+    config = (
+        args.output_dir,
+        args.format,
+        args.extension,
+        args.skew_angle,
+        args.random_skew,
+        args.blur,
+        args.random_blur,
+        args.background,
+        args.distortion,
+        args.distortion_orientation,
+        args.width,
+        args.alignment,
+        args.text_color,
+        args.orientation,
+        args.space_width,
+        args.language
+    )
+    font_seeds = sample_seeds(args.seed, np.arange(start, end), FONT)
+    if args.font_coverage:
+        coverage = CoverageIndex.for_language(fonts, args.language)
+        sample_fonts = coverage.choose(strings, font_seeds.tolist())
+        report = coverage.report(strings)
+        print("Font coverage: {} of {} samples restricted to fewer fonts, {} skipped as no font covers them".format(
+            report['constrained_samples'], report['samples'], report['uncovered_samples']))
+        with open(os.path.join(args.output_dir, 'font_coverage-{}-{}.json'.format(start, end)), 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        font_choices = font_seeds % np.uint64(len(fonts))
+        sample_fonts = [fonts[i] for i in font_choices.tolist()]
+
+    # Metrics count rendered samples only, the ones no font covers are never part of the total
+    rendered = [font is not None for font in sample_fonts]
+    metrics = Metrics('genara', args.metrics_path, args.metrics_port, total=sum(rendered),
+                      initial=sum(sum(rendered[first - start:last - start]) for first, last in checkpoint.completed))
+
+    stop = threading.Event()
+    # A worker of this run can get the pid of a worker of the resumed one, it must not append to
+    # that worker's shard: the shard would no longer be ordered by index, which finalize relies on
+    run_prefix = '{}-{}'.format(prefix, os.urandom(4).hex())
+    p = Pool(args.thread_count, initializer=init_worker, initargs=(run_prefix,))
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    batches = make_batches(checkpoint.pending(), start, strings, sample_fonts, args.seed, config, max(1, args.batch_size))
+    last_save = time.time()
+    with tqdm(total=string_count, initial=checkpoint.completed_count()) as pbar:
+        for first, last, count, offsets in dispatch(p, batches, 2 * args.thread_count, stop, metrics):
+            checkpoint.add(first, last, offsets)
+            pbar.update(last - first)
+            metrics.done(count)
+            if count < last - first:
+                metrics.inc('skipped_total', last - first - count, reason='font_coverage')
+            if time.time() - last_save >= args.checkpoint_interval:
+                checkpoint.save()
+                last_save = time.time()
+    p.close()
+    p.join()
+    checkpoint.save()
+    metrics.close()
+
+    if stop.is_set():
+        print("Interrupted, run again with --resume to continue")
+        return
+
+    # Images are already in their split folders, only the metadata shards are merged
+    if args.shard is None:
+        finalize(args.output_dir, args.manifest)
+    else:
+        print("Run formatdata.py on the output directory once every shard is done")
 
     # with open(os.path.join(args.output_dir, "labels.txt"), 'w', encoding="utf8") as f:
     #     for i in range(string_count):
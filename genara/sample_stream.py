@@ -0,0 +1,286 @@
+import multiprocessing as mp
+import queue
+import random
+import time
+import traceback
+import numpy as np
+
+from multiprocessing import shared_memory
+from PIL import Image, ImageFilter
+
+from background_generator import BackgroundGenerator
+from computer_text_generator import ComputerTextGenerator
+from distortion_generator import DistortionGenerator
+from seeding import FONT, new_run_seed, sample_seeds, seed_sample
+from string_generator import create_strings_from_dict
+
+# Same defaults as the command line arguments of run.py
+DEFAULT_SETTINGS = {
+    'size': 120,
+    'skewing_angle': 5,
+    'random_skew': True,
+    'blur': 1,
+    'random_blur': True,
+    'background_type': 0,
+    'distorsion_type': 0,
+    'distorsion_orientation': 0,
+    'width': 0,
+    'alignment': 1,
+    'text_color': '#000000,#362828',
+    'orientation': 0,
+    'space_width': 0.64,
+    'lang': 'ara',
+    'fused': False,
+}
+
+def _tick(timings, stage, t):
+    """
+        Add the time since t to the given stage, does nothing when timings is None
+    """
+
+    if timings is None:
+        return t
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.0) + now - t
+    return now
+
+class SampleRenderer(object):
+    @classmethod
+    def render(cls, text, font, size, skewing_angle, random_skew, blur, random_blur, background_type,
+               distorsion_type, distorsion_orientation, width, alignment, text_color, orientation, space_width, lang,
+               fused=False, timings=None):
+        """
+            Render one sample in memory and return it as an RGB Image, nothing is written to disk.
+            When a timings dict is given, the seconds spent in each stage are added to it.
+            With fused, skew and distortion are one coordinate remap (DistortionGenerator.skew_and_distort),
+            the text is composited in place into the background and the blur and RGB conversion passes are
+            skipped when they would not change the image
+        """
+
+        t = time.perf_counter() if timings is not None else None
+
+        ##########################
+        # Create picture of text #
+        ##########################
+        image = ComputerTextGenerator.generate(text, font, text_color, size, orientation, space_width, lang)
+        t = _tick(timings, 'text', t)
+
+        random_angle = random.randint(0 - skewing_angle, skewing_angle)
+        angle = skewing_angle if not random_skew else random_angle
+
+        vertical = distorsion_orientation == 0 or distorsion_orientation == 2
+        horizontal = distorsion_orientation == 1 or distorsion_orientation == 2
+
+        if fused:
+            distorted_img = DistortionGenerator.skew_and_distort(image, angle, distorsion_type, vertical, horizontal)
+            t = _tick(timings, 'distortion', t)
+        else:
+            rotated_img = image.rotate(angle, expand=1)
+            t = _tick(timings, 'skew', t)
+
+            #############################
+            # Apply distortion to image #
+            #############################
+            if distorsion_type == 0:
+                distorted_img = rotated_img
+            elif distorsion_type == 1:
+                distorted_img = DistortionGenerator.sin(rotated_img, vertical=vertical, horizontal=horizontal)
+            elif distorsion_type == 2:
+                distorted_img = DistortionGenerator.cos(rotated_img, vertical=vertical, horizontal=horizontal)
+            else:
+                distorted_img = DistortionGenerator.random(rotated_img, vertical=vertical, horizontal=horizontal)
+            t = _tick(timings, 'distortion', t)
+
+        ##################################
+        # Resize image to desired format #
+        ##################################
+        if orientation == 0:
+            new_width = int(float(distorted_img.size[0] + 10) * (float(size) / float(distorted_img.size[1] + 10)))
+            resized_img = distorted_img.resize((new_width, size - 10), Image.ANTIALIAS)
+            background_width = width if width > 0 else new_width + 10
+            background_height = size
+        else:
+            new_height = int(float(distorted_img.size[1] + 10) * (float(size) / float(distorted_img.size[0] + 10)))
+            resized_img = distorted_img.resize((size - 10, new_height), Image.ANTIALIAS)
+            background_width = size
+            background_height = new_height + 10
+        t = _tick(timings, 'resize', t)
+
+        #############################
+        # Generate background image #
+        #############################
+        if background_type == 0:
+            background = BackgroundGenerator.gaussian_noise(background_height, background_width)
+        elif background_type == 1:
+            background = BackgroundGenerator.plain_white(background_height, background_width)
+        elif background_type == 2:
+            background = BackgroundGenerator.quasicrystal(background_height, background_width)
+        else:
+            background = BackgroundGenerator.picture(background_height, background_width)
+        t = _tick(timings, 'background', t)
+
+        #############################
+        # Place text with alignment #
+        #############################
+        new_text_width, _ = resized_img.size
+
+        if alignment == 0 or width == -1:
+            position = (5, 5)
+        elif alignment == 1:
+            position = (int(background_width / 2 - new_text_width / 2), 5)
+        else:
+            position = (background_width - new_text_width - 5, 5)
+
+        background.paste(resized_img, position, resized_img)
+        t = _tick(timings, 'composite', t)
+
+        if fused:
+            # A radius of 0 leaves the image as it is, and it already is RGB for the built-in backgrounds
+            radius = blur if not random_blur else random.randint(0, blur)
+            if radius > 0:
+                background = background.filter(ImageFilter.GaussianBlur(radius=radius))
+            _tick(timings, 'blur', t)
+
+            return background if background.mode == 'RGB' else background.convert('RGB')
+
+        #######################
+        # Apply gaussian blur #
+        #######################
+        final_image = background.filter(
+            ImageFilter.GaussianBlur(
+                radius=(blur if not random_blur else random.randint(0, blur))
+            )
+        )
+
+        final_image = final_image.convert('RGB')
+        _tick(timings, 'blur', t)
+
+        return final_image
+
+def _produce(worker, workers, shm_name, slot_bytes, free_slots, ready, lang_dict, fonts, count,
+             length, allow_variable, seed, start, chunk_size, settings):
+    """
+        Producer process: renders the chunks worker, worker + workers, ... of the stream
+        into free shared memory slots and announces them on the ready queue
+    """
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    args = [settings[k] for k in DEFAULT_SETTINGS]
+    try:
+        chunk = worker
+        while count is None or chunk * chunk_size < count:
+            first = start + chunk * chunk_size
+            n = chunk_size if count is None else min(chunk_size, count - chunk * chunk_size)
+            strings = create_strings_from_dict(length, allow_variable, n, lang_dict, settings['lang'], seed, first)
+            font_choices = (sample_seeds(seed, np.arange(first, first + n), FONT) % np.uint64(len(fonts))).tolist()
+
+            for i, text in enumerate(strings):
+                seed_sample(seed, first + i)
+                pixels = np.asarray(SampleRenderer.render(text, fonts[font_choices[i]], *args))
+                slot = free_slots.get()
+                if pixels.nbytes <= slot_bytes:
+                    np.ndarray(pixels.shape, np.uint8, buffer=shm.buf, offset=slot * slot_bytes)[...] = pixels
+                    ready.put((slot, pixels.shape, text, None))
+                else:
+                    # Too large for a slot, send this one through the queue instead
+                    free_slots.put(slot)
+                    ready.put((None, pixels, text, None))
+            chunk += workers
+        ready.put((None, None, None, None))
+    except Exception:
+        ready.put((None, None, None, traceback.format_exc()))
+    finally:
+        shm.close()
+
+class SampleStream(object):
+    """
+        Iterable over (pixel array, text) pairs of the genara pipeline, rendered in memory by
+        a pool of producer processes. Samples are handed over through shared memory slots,
+        the number of slots bounds how far the producers run ahead of the consumer.
+        Samples come out in completion order, each one only depends on the seed and its index.
+
+        with SampleStream(lang_dict, fonts, count=10000, seed=1) as stream:
+            for pixels, text in stream:
+                ...
+    """
+
+    def __init__(self, lang_dict, fonts, count=None, length=1, allow_variable=True, seed=None, start=0,
+                 processes=4, prefetch=64, chunk_size=64, max_width=4096, **settings):
+        self.lang_dict = lang_dict
+        self.fonts = sorted(fonts)
+        self.count = count
+        self.length = length
+        self.allow_variable = allow_variable
+        self.seed = new_run_seed() if seed is None else seed
+        self.start = start
+        self.processes = processes
+        self.prefetch = prefetch
+        self.chunk_size = chunk_size
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        # A slot holds one RGB sample of at most max_width pixels along its long side
+        self.slot_bytes = self.settings['size'] * max_width * 3
+        self.shm = None
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for p in self.workers:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        self.workers = []
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __iter__(self):
+        self.close()
+        self.shm = shared_memory.SharedMemory(create=True, size=self.prefetch * self.slot_bytes)
+        free_slots = mp.Queue()
+        ready = mp.Queue()
+        for slot in range(self.prefetch):
+            free_slots.put(slot)
+
+        self.workers = [
+            mp.Process(
+                target=_produce,
+                args=(w, self.processes, self.shm.name, self.slot_bytes, free_slots, ready, self.lang_dict,
+                      self.fonts, self.count, self.length, self.allow_variable, self.seed, self.start,
+                      self.chunk_size, self.settings),
+                daemon=True,
+            )
+            for w in range(self.processes)
+        ]
+        for p in self.workers:
+            p.start()
+
+        try:
+            running = len(self.workers)
+            while running:
+                try:
+                    slot, shape, text, error = ready.get(timeout=1)
+                except queue.Empty:
+                    if not any(p.is_alive() for p in self.workers):
+                        raise RuntimeError("All sample producers died")
+                    continue
+
+                if error is not None:
+                    raise RuntimeError("Sample producer failed:\n" + error)
+                if shape is None:
+                    running -= 1
+                    continue
+
+                if slot is None:
+                    pixels = shape
+                else:
+                    pixels = np.ndarray(shape, np.uint8, buffer=self.shm.buf, offset=slot * self.slot_bytes).copy()
+                    free_slots.put(slot)
+                yield pixels, text
+        finally:
+            self.close()
@@ -0,0 +1,49 @@
+import random
+import numpy as np
+
+# Independent random streams derived from the same (run seed, sample index)
+TEXT, TEXT_LENGTH, FONT, RENDER = range(4)
+
+_MASK = 2 ** 64 - 1
+_GOLDEN = 0x9e3779b97f4a7c15
+_STREAM = 0xd1b54a32d192ed03
+
+def new_run_seed():
+    """
+        Draw a fresh run seed, to be printed so the run can be reproduced
+    """
+
+    return random.SystemRandom().getrandbits(63)
+
+def sample_seed(run_seed, index, stream=RENDER):
+    """
+        SplitMix64 hash of (run seed, sample index, stream). Any sample can be regenerated
+        from the run seed and its index alone, whichever worker or node rendered it.
+    """
+
+    z = (run_seed * _GOLDEN + (index + 1) * _STREAM + stream) & _MASK
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & _MASK
+    return z ^ (z >> 31)
+
+def sample_seeds(run_seed, indices, stream=RENDER):
+    """
+        Vectorized sample_seed over an array of indices, returns uint64 values
+    """
+
+    # uint64 arrays wrap around on overflow, which is exactly the modulo 2**64 we want
+    z = (np.asarray(indices, dtype=np.uint64) + np.uint64(1)) * np.uint64(_STREAM)
+    z += np.uint64((run_seed * _GOLDEN + stream) & _MASK)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+def seed_sample(run_seed, index):
+    """
+        Seed the global random and numpy generators used by the rendering code
+        (background, distortion, skew, blur and text color) for one sample
+    """
+
+    seed = sample_seed(run_seed, index, RENDER)
+    random.seed(seed)
+    np.random.seed(seed & 0xffffffff)
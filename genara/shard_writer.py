@@ -0,0 +1,127 @@
+import glob
+import heapq
+import json
+import os
+import socket
+import zlib
+
+splits = [0.8, 0.1, 0.1]
+folders = ['train', 'test', 'validation']
+
+# Host name by default, keeps shards of several machines apart on a shared file system
+shard_prefix = socket.gethostname()
+
+def set_shard_prefix(prefix):
+    """
+        Set the prefix of the shards written by this process
+    """
+
+    global shard_prefix
+    shard_prefix = prefix
+
+def shard_paths(output_dir, prefix):
+    """
+        All metadata shards with the given prefix, in every split
+    """
+
+    return [
+        path
+        for folder in folders
+        for path in glob.glob(os.path.join(output_dir, folder, 'metadata-{}-*.jsonl'.format(glob.escape(prefix))))
+    ]
+
+def assign_split(index):
+    """
+        Deterministically assign a sample index to a split, following the split ratios
+    """
+
+    # Hash the index so consecutive samples are spread over the splits
+    u = zlib.crc32(str(index).encode()) / 2 ** 32
+    total = 0
+    for s, p in enumerate(splits):
+        total += p
+        if u < total:
+            return s
+    return len(splits) - 1
+
+def make_split_dirs(output_dir):
+    """
+        Create one folder per split in the output directory
+    """
+
+    for folder in folders:
+        os.makedirs(os.path.join(output_dir, folder), exist_ok=True)
+
+def metadata_row(file_name, text):
+    """
+        Metadata line of one sample, in the Donut format used by mageXML
+    """
+
+    return {
+        'file_name': file_name,
+        'ground_truth': json.dumps({'gt_parse': {'text_sequence': " ".join(text.split())}}, ensure_ascii=False)
+    }
+
+def write_shard(output_dir, rows):
+    """
+        Append a batch of metadata rows to this worker's shard of each split.
+        rows is a list of (split, row) tuples. Returns the size of every shard
+        written to, right after the batch was appended
+    """
+
+    by_split = {}
+    for s, row in rows:
+        by_split.setdefault(s, []).append(json.dumps(row, ensure_ascii=False) + '\n')
+
+    offsets = {}
+    for s, lines in by_split.items():
+        path = os.path.join(output_dir, folders[s], 'metadata-{}-{}.jsonl'.format(shard_prefix, os.getpid()))
+        with open(path, 'ab') as f:
+            f.write(''.join(lines).encode('utf8'))
+            offsets[path] = f.tell()
+    return offsets
+
+def _sample_index(line):
+    return int(json.loads(line)['file_name'].split('.')[0])
+
+def finalize(output_dir, manifest=False):
+    """
+        Merge the per-worker metadata shards of every split into its metadata.jsonl.
+        Each shard is already ordered by index, so this is a streaming k-way merge,
+        no image is touched. Rows written twice for the same image are only kept once.
+        With manifest, the rows of every split also go to <output_dir>/manifest.parquet
+    """
+
+    writer = None
+    if manifest:
+        from manifest import ManifestWriter
+        writer = ManifestWriter(os.path.join(output_dir, 'manifest.parquet'))
+
+    try:
+        for folder in folders:
+            shards = sorted(glob.glob(os.path.join(output_dir, folder, 'metadata-*.jsonl')))
+            files = [open(shard, 'r', encoding='utf8') for shard in shards]
+            try:
+                with open(os.path.join(output_dir, folder, 'metadata.jsonl'), 'w', encoding='utf8') as out:
+                    previous = None
+                    for line in heapq.merge(*files, key=_sample_index):
+                        index = _sample_index(line)
+                        if index != previous:
+                            out.write(line)
+                            if writer is not None:
+                                row = json.loads(line)
+                                writer.write(
+                                    file_name=row['file_name'],
+                                    shard=folder,
+                                    split=folder,
+                                    source='genara',
+                                    index=index,
+                                    ground_truth=json.loads(row['ground_truth'])['gt_parse']['text_sequence'],
+                                )
+                        previous = index
+            finally:
+                for f in files:
+                    f.close()
+    finally:
+        if writer is not None:
+            writer.close()
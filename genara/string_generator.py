@@ -1,36 +1,105 @@
-import random
+import mmap
+import os
+import numpy as np
 
-def create_strings_from_file(filename, count, length):
+from seeding import TEXT, TEXT_LENGTH, new_run_seed, sample_seeds
+
+def load_dict(lang):
+    """
+        Read the dictionnary file and returns all words in it.
+    """
+
+    lang_dict = []
+    with open(os.path.join('dicts', lang) + ".txt", 'r', encoding="utf8", errors='ignore') as d:
+        lang_dict = d.readlines()
+    return lang_dict
+
+def iter_corpus_lines(filename):
+    """
+        Stream the stripped lines of a corpus file through a memory map, so the
+        corpus never has to fit in RAM
+    """
+
+    with open(filename, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be memory mapped
+            return
+        with mm:
+            for line in iter(mm.readline, b''):
+                yield line.decode('utf8').strip()
+
+def count_corpus_lines(filename):
+    """
+        Count the lines of a corpus file in fixed size chunks
+    """
+
+    lines = 0
+    last = b'\n'
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    return lines + (last != b'\n')
+
+def sample_lengths(seed, indices, length, allow_variable=True):
     """
-        Create all strings by reading lines in specified files
+        Word count of each sample, between 1 and length if allow_variable
     """
+
+    if not allow_variable:
+        return np.full(len(indices), length, dtype=np.int64)
+    return (sample_seeds(seed, indices, TEXT_LENGTH) % np.uint64(length)).astype(np.int64) + 1
+
+def create_strings_from_file(filename, count, length, seed=None, start=0):
+    """
+        Create all strings by reading lines in specified files.
+        Sample i uses line i (wrapping around the corpus), truncated to a word count
+        derived from the run seed and i.
+    """
+    if seed is None:
+        seed = new_run_seed()
+
+    path = 'corpus/' + filename
+    line_count = count_corpus_lines(path)
+    if line_count == 0:
+        raise Exception("No lines could be read in file")
+
+    lengths = sample_lengths(seed, np.arange(start, start + count), length).tolist()
     strings = []
 
-    with open('corpus/' + filename, 'r', encoding="utf8") as f:
-        lines = [l.strip() for l in f.readlines()]
-        lines = [" ".join(l.split()[::-1][0:random.randint(1, length)]) for l in lines]
-        if len(lines) == 0:
-            raise Exception("No lines could be read in file")
-        while len(strings) < count:
-            # if lang == 'fa'
-            if len(lines) >= count - len(strings):
-                strings.extend(lines[0:count - len(strings)])
-            else:
-                strings.extend(lines)
+    skip = start % line_count
+    while len(strings) < count:
+        for i, l in enumerate(iter_corpus_lines(path)):
+            if i < skip:
+                continue
+            strings.append(" ".join(l.split()[::-1][0:lengths[len(strings)]]))
+            if len(strings) >= count:
+                break
+        skip = 0
     return strings
 
-def create_strings_from_dict(length, allow_variable, count, lang_dict, lang):
+def create_strings_from_dict(length, allow_variable, count, lang_dict, lang, seed=None, start=0):
     """
-        Create all strings by picking X random word in the dictionnary
+        Create all strings by picking X random word in the dictionnary.
+        Word counts and word indices of samples start..start+count are drawn at once,
+        each from the run seed and the sample index only.
     """
     print(lang)
 
-    dict_len = len(lang_dict)
-    strings = []
-    for _ in range(0, count):
-        current_string = ""
-        for _ in range(0, random.randint(1, length) if allow_variable else length):
-            current_string = lang_dict[random.randrange(dict_len)] + current_string
-            current_string = ' ' + current_string
-        strings.append(current_string)
-    return strings
+    if seed is None:
+        seed = new_run_seed()
+
+    indices = np.arange(start, start + count)
+    lengths = sample_lengths(seed, indices, length, allow_variable)
+
+    # One draw per (sample, word slot), only the first lengths[i] slots of sample i are used
+    slots = indices[:, None] * length + np.arange(length)
+    words = sample_seeds(seed, slots, TEXT) % np.uint64(len(lang_dict))
+    words = words[np.arange(length) < lengths[:, None]]
+
+    ends = np.cumsum(lengths).tolist()
+    words = np.asarray(lang_dict, dtype=object)[words.astype(np.int64)].tolist()
+
+    return [' ' + ' '.join(words[end - n:end]) for n, end in zip(lengths.tolist(), ends)]
@@ -1,6 +1,7 @@
 from PIL import Image
 from trp import TextLine, PageXML ## need these from trp
 import numpy as np
+import argparse
 import os
 import json
 import traceback
@@ -233,7 +234,7 @@ def bounding_box(baselines: list[TextLine]) -> list[list[int]]:
 
 
 ## crop the image
-def slice_img(page: PageXML, coords: list[list], image_dir="") -> Image:
+def slice_img(page: PageXML, coords: list[list], image_dir="", image=None) -> Image:
     """
     returns an Image cropped to the text region of the page marked by the coords
 
@@ -244,6 +245,12 @@ def slice_img(page: PageXML, coords: list[list], image_dir="") -> Image:
 
     coords : list[list]
         a list of two points, the first is the top-left point of the region and the second is the bottom-right corner
+
+    image_dir : str
+        (optional) directory of the page image
+
+    image : Image
+        (optional) the page image, already in memory. when given, nothing is read from disk
     
     Returns
     -------
@@ -257,6 +264,9 @@ def slice_img(page: PageXML, coords: list[list], image_dir="") -> Image:
 
     top, right, bottom, left = coords[0][1], coords[1][0], coords[1][1], coords[0][0]
     
+    if image is not None:
+        return image.crop((left, top, right, bottom))
+
     if image_dir:
         image_name = image_dir + "/" + image_name
 
@@ -306,9 +316,9 @@ def slice_from_col(lines: list[TextLine], min_height=0, max_height=0) -> list[Te
 
 
 ## determine image slices and ground truth of each slice
-def decide_slices(page: PageXML, pred_length=140) -> list[dict]:
+def decide_slices(page: PageXML, pred_length=140, line_length=None, keep_long_lines=False) -> list[dict]:
     """
-    returns a list of dicts, each dict containing the top left point coordinates, bottom right point coordinates, and ground_truth of a slice
+    returns a list of dicts, each dict containing the top left point coordinates, bottom right point coordinates, ground_truth and lines of a slice
 
      Parameters
     ----------
@@ -317,13 +327,22 @@ def decide_slices(page: PageXML, pred_length=140) -> list[dict]:
 
     pred_length : int
         maximum length of the prediction by Donut, each image slice will have this many characters or less, if possible
+
+    line_length : function
+        (optional) number of characters of a TextLine, defaults to the length of its transcription. pages that are not transcribed yet need an estimate instead
+
+    keep_long_lines : bool
+        (optional) a single line longer than pred_length is skipped by default, as a training sample it would teach Donut a truncated transcription. when transcribing a page every line has to be predicted, so with keep_long_lines it becomes a slice of its own instead
     
     Returns
     -------
     list[dict]
-        a list of dicts containing top left point coordinates, bottom right point coordinates, and ground_truth of each slice
+        a list of dicts containing top left point coordinates, bottom right point coordinates, ground_truth and the TextLines of each slice
     """
 
+    if line_length is None:
+        line_length = lambda line: len(line.txt) if line.txt is not None else 0
+
     ## get image dims
     x, y = page.get_image_dims()
 
@@ -361,13 +380,22 @@ def decide_slices(page: PageXML, pred_length=140) -> list[dict]:
             new_text = slice_from_col(lines, bottom, new_bottom)
             
             gt = "".join([ line.txt for line in new_text if line.txt is not None])
-            new_text_len = len(gt)
+            new_text_len = sum(line_length(line) for line in new_text)
 
 
-            ## one line is longer than the pred_length and we should skip this line
+            ## one line is longer than the pred_length and we should skip this line, or slice it on its own
             if len(new_text) == 1 and new_text_len > pred_length:
                 coords = bounding_box(new_text)
-                bottom = coords[1][1] + 1
+                real_bottom = coords[1][1] + 1
+                if keep_long_lines:
+                    coords[0][1] = bottom
+                    coords[1][1] += int(0.005 * y)
+                    slices.append({
+                        "coords": coords,
+                        "ground_truth": gt,
+                        "lines": new_text
+                    })
+                bottom = real_bottom
             elif new_text_len == 0:
                 if new_bottom > y:
                     break
@@ -397,7 +425,8 @@ def decide_slices(page: PageXML, pred_length=140) -> list[dict]:
 
                 slices.append({
                     "coords": coords,
-                    "ground_truth": gt
+                    "ground_truth": gt,
+                    "lines": new_text
                 })
                 bottom = real_bottom
             else:
@@ -422,7 +451,8 @@ def decide_slices(page: PageXML, pred_length=140) -> list[dict]:
 
                 slices.append({
                     "coords": coords,
-                    "ground_truth": gt
+                    "ground_truth": gt,
+                    "lines": new_text
                 })
                 bottom = real_bottom
 
@@ -430,26 +460,134 @@ def decide_slices(page: PageXML, pred_length=140) -> list[dict]:
 
 
 
-## write metadata to file
-def create_metadata(page: PageXML, pred_length=140) -> None:
+## compact, array backed form of the slices of a page
+def make_plan(page: PageXML, slices: list[dict]) -> dict[str, np.ndarray]:
     """
-    saves image slices as new images and writes metadata to file in Donut format
+    returns the slice plan of a page: everything needed to cut and label its slices, without the PageXML
 
     Parameters
     ----------
     page : PageXML
-        the PageXML object of the page we want to create training data from
+        the PageXML object of the page the slices were decided for
+
+    slices : list[dict]
+        the slices of the page, as returned by decide_slices
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        coords : int32 array of shape (n, 4), left, top, right and bottom of every slice in page pixels
+        text : uint8 array, the utf-8 ground truths of all slices one after the other
+        text_offsets : int64 array of shape (n + 1,), slice i's ground truth is text[text_offsets[i]:text_offsets[i+1]]
+        image_name, image_size : the page image and the (width, height) the coords are relative to
+    """
+
+    image_name, x, y = page.get_image_data()
+
+    coords = np.array(
+        [[s['coords'][0][0], s['coords'][0][1], s['coords'][1][0], s['coords'][1][1]] for s in slices],
+        dtype=np.float64,
+    ).reshape(-1, 4)
+    texts = [s['ground_truth'].encode('utf8') for s in slices]
+
+    return {
+        'coords': np.round(coords).astype(np.int32),
+        'text': np.frombuffer(b''.join(texts), dtype=np.uint8),
+        'text_offsets': np.cumsum([0] + [len(t) for t in texts], dtype=np.int64),
+        'image_name': np.array(image_name),
+        'image_size': np.array([int(x), int(y)], dtype=np.int32),
+    }
+
+
+
+## save and load slice plans
+def save_plan(plan: dict[str, np.ndarray], path: str) -> None:
+    """
+    saves a slice plan as a compressed .npz file
+
+    Parameters
+    ----------
+    plan : dict[str, np.ndarray]
+        the plan, as returned by make_plan
+
+    path : str
+        the file to write, usually <page>.npz in a plan directory
+
+    Returns
+    -------
+    None
+    """
+
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    np.savez_compressed(path, **plan)
+
+
+def load_plan(path: str) -> dict[str, np.ndarray]:
+    """
+    returns the slice plan saved at path
+
+    Parameters
+    ----------
+    path : str
+        the .npz file written by save_plan
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        the plan, as returned by make_plan
+    """
+
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def plan_ground_truth(plan: dict[str, np.ndarray], i: int) -> str:
+    """
+    returns the ground truth of slice i of the plan
+    """
+
+    return plan['text'][plan['text_offsets'][i]:plan['text_offsets'][i + 1]].tobytes().decode('utf8')
+
+
+
+## crop and encode the slices of a plan
+def execute_plan(plan: dict[str, np.ndarray], image_dir='raw_images', out_dir='dataset', image_format='jpg', scale=1.0, quality=None, manifest=None) -> None:
+    """
+    saves the slices of a plan as images and writes their metadata in Donut format. no layout analysis is done,
+    only cropping and encoding, so the same plan can be written out again in another format or resolution
+
+    Parameters
+    ----------
+    plan : dict[str, np.ndarray]
+        the plan, as returned by make_plan or load_plan
+
+    image_dir : str
+        directory of the page images. when a page image has another resolution than the one the plan was made on, the coords are scaled to it
+
+    out_dir : str
+        directory the dataset is written to, one folder per set
+
+    image_format : str
+        file extension of the slice images, e.g. jpg, png or webp
+
+    scale : float
+        factor the slice images are resized by before they are saved
+
+    quality : int
+        (optional) encoder quality, for the lossy formats
+
+    manifest : ManifestWriter
+        (optional) manifest the slices are also written to, with their source page and coordinates
 
-    pred_length : int
-        maximum length of the prediction by Donut, each image slice will have this many characters or less, if possible
-    
     Returns
     -------
     None
     """
 
-    page_name = page.get_image_data()[0].split('.')[0]
-    slices = decide_slices(page, pred_length)
+    image_name = str(plan['image_name'])
+    page_name = image_name.split('.')[0]
 
     splits = [0.8, 0.1, 0.1]
     sets = ['train', 'validation', 'test']
@@ -457,40 +595,107 @@ def create_metadata(page: PageXML, pred_length=140) -> None:
     ## make set folders
     for s in sets:
         ## Check if the directory already exists
-        if not os.path.exists('dataset/' + s):
+        if not os.path.exists(os.path.join(out_dir, s)):
             ## Create the directory
-            os.makedirs('dataset/' + s)
+            os.makedirs(os.path.join(out_dir, s))
+
+    if len(plan['coords']) == 0:
+        return
+
+    im = Image.open(os.path.join(image_dir, image_name) if image_dir else image_name)
+    im.load()
+
+    ## the plan may have been made on a scan of another resolution
+    coords = plan['coords'].astype(np.float64)
+    coords[:, [0, 2]] *= im.width / plan['image_size'][0]
+    coords[:, [1, 3]] *= im.height / plan['image_size'][1]
+
+    save_args = {} if quality is None else {'quality': quality}
 
-    for i, s in enumerate(slices):
+    for i, (left, top, right, bottom) in enumerate(coords):
         ## crop
-        im = slice_img(page, s['coords'], 'raw_images')
+        slice_im = im.crop((left, top, right, bottom))
+        if scale != 1.0:
+            slice_im = slice_im.resize((max(1, round(slice_im.width * scale)), max(1, round(slice_im.height * scale))), Image.BILINEAR)
 
         ## decide which set
         assigned_set = sets[np.random.choice(3, p=splits)]
 
-        im_name = f'dataset/{assigned_set}/{page_name}_{i}.jpg'
+        im_name = os.path.join(out_dir, assigned_set, f'{page_name}_{i}.{image_format}')
 
         ## save image
-        im.save(im_name)
+        if image_format.lower() in ('jpg', 'jpeg') and slice_im.mode not in ('RGB', 'L'):
+            slice_im = slice_im.convert('RGB')
+        slice_im.save(im_name, **save_args)
 
+        gt = plan_ground_truth(plan, i)
         d = {
-            'file_name': im_name.split('/')[2],
-            'ground_truth': f"{{\"gt_parse\": {{\"text_sequence\": \"{s['ground_truth']}\" }} }}"
+            'file_name': os.path.basename(im_name),
+            ## a JSON string of its own, escaped by json so quotes and backslashes in the transcription survive
+            'ground_truth': json.dumps({'gt_parse': {'text_sequence': gt}}, ensure_ascii=False)
         }
 
         ## write metadata
-        with open(f"dataset/{assigned_set}/metadata.jsonl", 'a') as f:
+        with open(os.path.join(out_dir, assigned_set, 'metadata.jsonl'), 'a') as f:
             json.dump(d,f)
             f.write('\n')
 
+        if manifest is not None:
+            manifest.write(
+                file_name=d['file_name'],
+                shard=assigned_set,
+                split=assigned_set,
+                source=image_name,
+                index=i,
+                coords=[[left, top], [right, bottom]],
+                ground_truth=gt,
+            )
+
+
+
+## write metadata to file
+def create_metadata(page: PageXML, pred_length=140, manifest=None, image_dir='raw_images', out_dir='dataset', plan_path=None) -> None:
+    """
+    saves image slices as new images and writes metadata to file in Donut format
+
+    Parameters
+    ----------
+    page : PageXML
+        the PageXML object of the page we want to create training data from
+
+    pred_length : int
+        maximum length of the prediction by Donut, each image slice will have this many characters or less, if possible
+
+    manifest : ManifestWriter
+        (optional) manifest the slices are also written to, with their source page and coordinates
+
+    image_dir : str
+        directory of the page images
+
+    out_dir : str
+        directory the dataset is written to, one folder per set
+
+    plan_path : str
+        (optional) file the slice plan of the page is saved to, so it can be executed again later without slicing
+    
+    Returns
+    -------
+    None
+    """
+
+    plan = make_plan(page, decide_slices(page, pred_length))
+    if plan_path:
+        save_plan(plan, plan_path)
+    execute_plan(plan, image_dir, out_dir, manifest=manifest)
+
 
 
 ## take in all xml in folder and make the training data
-def create_dataset(xml_dir: str, verbose=True) -> None:
+def create_dataset(xml_dir: str, verbose=True, manifest_path=None, image_dir='raw_images', out_dir='dataset', pred_length=140, plan_dir=None, metrics_path=None, metrics_port=None) -> None:
     """
     create the full dataset for donut, based off the xml files in the xml_dir
 
-    images for the pages should be in a folder called 'raw_images' that is in the same parent directory as this python file
+    images for the pages should be in image_dir, by default a folder called 'raw_images' in the working directory
 
     Parameters
     ----------
@@ -500,36 +705,161 @@ def create_dataset(xml_dir: str, verbose=True) -> None:
     verbose: bool
         whether or not to print the name of the file being processed
 
+    manifest_path : str
+        (optional) Parquet manifest of all slices to write, e.g. 'dataset/manifest.parquet'. needs pyarrow
+
+    image_dir : str
+        directory of the page images
+
+    out_dir : str
+        directory the dataset is written to
+
+    pred_length : int
+        maximum length of the prediction by Donut, each image slice will have this many characters or less, if possible
+
+    plan_dir : str
+        (optional) directory the slice plan of every page is saved to, as <page>.npz
+
+    metrics_path : str
+        (optional) Prometheus text file the live page count, pages/sec, errors, ETA and memory are written to
+
+    metrics_port : int
+        (optional) local port the same metrics are served on
+
     Returns
     -------
     None
     """
 
     dir = os.fsencode(xml_dir)
+    files = [os.fsdecode(file) for file in os.listdir(dir)]
+
+    manifest = None
+    if manifest_path:
+        from manifest import ManifestWriter
+        manifest = ManifestWriter(manifest_path)
+    from metrics import Metrics
+    metrics = Metrics('magexml', metrics_path, metrics_port, total=sum(f.endswith('.xml') for f in files))
     
-    for file in os.listdir(dir):
-        filename = os.fsdecode(file)
+    for filename in files:
         if filename.endswith(".xml"): 
             try:
-                page = parse_xml('pages/' + filename)
-                create_metadata(page)
+                page = parse_xml(os.path.join(xml_dir, filename))
+                plan_path = os.path.join(plan_dir, filename[:-len('.xml')] + '.npz') if plan_dir else None
+                create_metadata(page, pred_length, manifest, image_dir, out_dir, plan_path)
             except KeyboardInterrupt:
                 ## keyboard interrupt will skip a file that is taking too long
                 ## it will not stop the program!
                 print('Interrupted!')
                 print(f'    Error with file: {filename}')
                 traceback.print_exc()
+                metrics.error('KeyboardInterrupt')
             except Exception as e:
                 print(f"Error with file: {filename}")
                 print(f'    {e}')
                 traceback.print_exc()
+                metrics.error(e)
+            metrics.done()
             if verbose:
                 print(f'Processed page: {filename}')
         else:
             continue
 
+    metrics.close()
+    if manifest is not None:
+        manifest.close()
+
 
 
+## write the dataset again from saved plans
+def execute_plans(plan_dir: str, verbose=True, manifest_path=None, image_dir='raw_images', out_dir='dataset', image_format='jpg', scale=1.0, quality=None, metrics_path=None, metrics_port=None) -> None:
+    """
+    create the dataset from the slice plans saved by create_dataset, only cropping and encoding the slices
+
+    Parameters
+    ----------
+    plan_dir : str
+        the directory of the .npz slice plans
+
+    verbose: bool
+        whether or not to print the name of the plan being executed
+
+    manifest_path : str
+        (optional) Parquet manifest of all slices to write. needs pyarrow
+
+    image_dir : str
+        directory of the page images
+
+    out_dir : str
+        directory the dataset is written to
+
+    image_format : str
+        file extension of the slice images
+
+    scale : float
+        factor the slice images are resized by
+
+    quality : int
+        (optional) encoder quality, for the lossy formats
+
+    metrics_path : str
+        (optional) Prometheus text file the live plan count, plans/sec, errors, ETA and memory are written to
+
+    metrics_port : int
+        (optional) local port the same metrics are served on
+
+    Returns
+    -------
+    None
+    """
 
-###### RUNNING THE CODE, CHANGE THIS LINE IF NECESSARY
-create_dataset('pages')
+    manifest = None
+    if manifest_path:
+        from manifest import ManifestWriter
+        manifest = ManifestWriter(manifest_path)
+    plans = [f for f in sorted(os.listdir(plan_dir)) if f.endswith('.npz')]
+    from metrics import Metrics
+    metrics = Metrics('magexml', metrics_path, metrics_port, total=len(plans))
+
+    for filename in plans:
+        try:
+            execute_plan(load_plan(os.path.join(plan_dir, filename)), image_dir, out_dir, image_format, scale, quality, manifest)
+        except Exception as e:
+            print(f"Error with plan: {filename}")
+            print(f'    {e}')
+            traceback.print_exc()
+            metrics.error(e)
+        metrics.done()
+        if verbose:
+            print(f'Executed plan: {filename}')
+
+    metrics.close()
+    if manifest is not None:
+        manifest.close()
+
+
+
+###### RUNNING THE CODE
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="slice Transkribus pages into Donut training data")
+    parser.add_argument("--xml_dir", type=str, default="pages") ## PageXML files of the pages
+    parser.add_argument("--image_dir", type=str, default="raw_images") ## the page images
+    parser.add_argument("--out_dir", type=str, default="dataset") ## train, validation and test folders are made in here
+    parser.add_argument("--pred_length", type=int, default=140) ## maximum number of characters per slice
+    parser.add_argument("--manifest_path", type=str, default=None) ## also write a Parquet manifest of all slices, needs pyarrow
+    parser.add_argument("--quiet", action="store_true") ## do not print every processed page
+    parser.add_argument("--plan_dir", type=str, default=None) ## save the slice plan of every page here
+    parser.add_argument("--execute_plans", action="store_true") ## only crop and encode the plans in --plan_dir, no slicing
+    parser.add_argument("--format", type=str, default="jpg") ## slice image format when executing plans
+    parser.add_argument("--scale", type=float, default=1.0) ## resize factor of the slice images when executing plans
+    parser.add_argument("--quality", type=int, default=None) ## encoder quality when executing plans
+    parser.add_argument("--metrics_path", type=str, default=None) ## Prometheus text file with live progress, errors and memory
+    parser.add_argument("--metrics_port", type=int, default=None) ## serve the same metrics on this local port
+    args = parser.parse_args()
+
+    if args.execute_plans:
+        if not args.plan_dir:
+            parser.error("--execute_plans needs --plan_dir")
+        execute_plans(args.plan_dir, not args.quiet, args.manifest_path, args.image_dir, args.out_dir, args.format, args.scale, args.quality, args.metrics_path, args.metrics_port)
+    else:
+        create_dataset(args.xml_dir, not args.quiet, args.manifest_path, args.image_dir, args.out_dir, args.pred_length, args.plan_dir, args.metrics_path, args.metrics_port)
@@ -0,0 +1,107 @@
+"""
+columnar manifest of a dataset or of an inference run, one Parquet row per sample, shared by genara, mageXML and
+donut_utils. every tool fills the columns it knows and leaves the others null, so manifests of the same samples
+can be joined on file_name
+
+pyarrow is only imported when a manifest is actually read or written
+"""
+
+import os
+
+## (name, pyarrow type name), in file order
+COLUMNS = [
+    ("file_name", "string"),       ## file name of the sample, as in Donut's metadata.jsonl
+    ("shard", "string"),           ## folder or archive the sample is stored in, relative to the manifest
+    ("offset", "int64"),           ## byte offset of the sample in its shard when the shard is an archive
+    ("split", "string"),           ## train, test or validation
+    ("source", "string"),          ## page the slice was cut from, or the generator of a synthetic sample
+    ("index", "int64"),            ## sample index of a synthetic sample, or slice index on its page
+    ("left", "int32"),             ## box of the slice on its page, written as coords=[[left, top], [right, bottom]]
+    ("top", "int32"),
+    ("right", "int32"),
+    ("bottom", "int32"),
+    ("ground_truth", "string"),    ## plain ground truth text, not the escaped json of metadata.jsonl
+    ("prediction", "string"),      ## predicted text_sequence
+    ("inference_ms", "float32"),   ## model time of the sample
+]
+
+
+def schema():
+    import pyarrow as pa
+
+    types = {
+        "string": pa.string(),
+        "int64": pa.int64(),
+        "int32": pa.int32(),
+        "float32": pa.float32(),
+    }
+    return pa.schema([(name, types[t]) for name, t in COLUMNS])
+
+
+class ManifestWriter:
+    """
+    writes manifest rows to a Parquet file, buffered in memory and flushed one row group at a time
+    """
+
+    def __init__(self, path: str, row_group_size=65536):
+        import pyarrow.parquet as pq
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = schema()
+        self.columns = {name: [] for name, _ in COLUMNS}
+        self.rows = 0
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, coords=None, **row) -> None:
+        if coords is not None:
+            (row["left"], row["top"]), (row["right"], row["bottom"]) = [[int(v) for v in p] for p in coords]
+        for name, values in self.columns.items():
+            values.append(row.get(name))
+        self.rows += 1
+        if self.rows == self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        import pyarrow as pa
+
+        if not self.rows:
+            return
+        self.writer.write_table(pa.table(self.columns, schema=self.schema))
+        self.columns = {name: [] for name in self.columns}
+        self.rows = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_manifest(path: str, columns=None, filters=None):
+    """
+    manifest as a pyarrow Table, memory mapped so only the columns and row groups asked for are read. filters
+    are pyarrow's, e.g. [("split", "=", "test")]
+    """
+
+    import pyarrow.parquet as pq
+
+    return pq.read_table(path, columns=columns, filters=filters, memory_map=True)
+
+
+def join_predictions(dataset, predictions):
+    """
+    samples of a dataset manifest joined with the predictions of an inference manifest on file_name, only the
+    samples that have a prediction are kept
+    """
+
+    predicted = predictions.select(["file_name", "prediction", "inference_ms"])
+    return dataset.drop_columns(["prediction", "inference_ms"]).join(predicted, "file_name", join_type="inner")
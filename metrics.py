@@ -0,0 +1,239 @@
+"""
+live metrics of the long running jobs (mageXML's create_dataset, genara's run.py, donut_utils' inferencing.py) in
+the Prometheus text format: rewritten to a file every interval, for node_exporter's textfile collector, and/or served
+on a local port for a scraper
+
+the hot paths only add to a dict. items/sec, ETA and the RSS of the process and of its worker processes are worked
+out by a background thread once per interval, never per item
+"""
+
+import os
+import threading
+import time
+
+## every metric name starts with this, the tool is the job label
+PREFIX = "pipeline"
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes(pid: int):
+    """
+    resident memory of a process from /proc, None when it is gone or there is no /proc
+    """
+
+    try:
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def child_pids(pid: int) -> list:
+    """
+    direct children of a process, e.g. the workers of a Pool or DataLoader
+    """
+
+    children = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return children
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ## the command name is in parentheses and may contain spaces, the parent pid is the second field after it
+        fields = stat[stat.rfind(b")") + 2:].split()
+        if len(fields) > 1 and int(fields[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _value(value) -> str:
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class Metrics:
+    """
+    counters and gauges of one job, exported while it runs
+
+    - done(n): n more items processed, items_total
+    - error(e): errors_total by exception type
+    - inc(name, n, **labels) / set(name, value, **labels): any other counter or gauge, e.g. queue depths
+
+    the memory of the process and of its worker processes (its direct children) is exported as rss_bytes with
+    role main or workers, worker_rss_max_bytes and workers
+
+    with total, the ETA is the remaining items over the items/sec of the last interval. initial is the number of
+    items already done before this run (resumed runs), it counts towards the total but not the rate. without path
+    and port nothing is exported and nothing runs in the background
+    """
+
+    def __init__(self, job: str, path=None, port=None, interval=10.0, total=None, initial=0, host="127.0.0.1"):
+        self.job = job
+        self.path = path
+        self.total = total
+        self.interval = interval
+        self.initial = initial
+
+        self._counters = {("items_total", ()): initial}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last = (time.monotonic(), initial)
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+        if port is not None:
+            from http.server import ThreadingHTTPServer
+
+            self._server = ThreadingHTTPServer((host, port), self._handler())
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        if path is not None or port is not None:
+            self._update()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def inc(self, name: str, value=1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def done(self, n=1) -> None:
+        self.inc("items_total", n)
+
+    def error(self, error, **labels) -> None:
+        self.inc("errors_total", type=error if isinstance(error, str) else type(error).__name__, **labels)
+
+    def _update(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            items = self._counters[("items_total", ())]
+        last_time, last_items = self._last
+        self._last = (now, items)
+
+        elapsed = time.time() - self._start
+        rate = (items - last_items) / (now - last_time) if now > last_time else 0.0
+        average = (items - self.initial) / elapsed if elapsed > 0 else 0.0
+        self.set("elapsed_seconds", elapsed)
+        self.set("items_per_second", rate)
+        self.set("items_per_second_average", average)
+        if self.total is not None:
+            self.set("items_expected", self.total)
+            speed = rate or average
+            self.set("eta_seconds", max(self.total - items, 0) / speed if speed > 0 else float("nan"))
+
+        ## workers are not labelled by pid, pool and loader workers get new pids on every run and restart, which
+        ## would make new series each time. their memory is exported as a total and the largest single worker
+        pid = os.getpid()
+        main = rss_bytes(pid)
+        if main is not None:
+            workers = [rss for rss in map(rss_bytes, child_pids(pid)) if rss is not None]
+            self.set("rss_bytes", main, role="main")
+            self.set("rss_bytes", sum(workers), role="workers")
+            self.set("worker_rss_max_bytes", max(workers, default=0))
+            self.set("workers", len(workers))
+
+    def render(self) -> str:
+        """
+        every metric in the Prometheus text exposition format
+        """
+
+        with self._lock:
+            counters = list(self._counters.items())
+            gauges = list(self._gauges.items())
+        job = (("job", self.job),)
+
+        lines = []
+        for kind, samples in (("counter", counters), ("gauge", gauges)):
+            by_name = {}
+            for (name, labels), value in samples:
+                by_name.setdefault(name, []).append((labels, value))
+            for name in sorted(by_name):
+                lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+                for labels, value in sorted(by_name[name]):
+                    lines.append(f"{PREFIX}_{name}{_labels(job + labels)} {_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _write(self) -> None:
+        ## written next to the file and renamed, a collector never reads half a file
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, self.path)
+
+    def _run(self) -> None:
+        while True:
+            if self.path is not None:
+                self._write()
+            if self._stop.wait(self.interval):
+                return
+            self._update()
+
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self) -> None:
+        """
+        stop exporting, after writing the final values
+        """
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self._update()
+            if self.path is not None:
+                self._write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,99 @@
+"""
+startup time of every command line entry point, i.e. what a short job or a spawned worker pays before doing
+anything. each script is run with --help from its own folder, as the tools are run, and timed over a few
+repeats. python -X importtime then gives the imports that cost the most
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+## (folder, script)
+ENTRY_POINTS = [
+    ("genara", "run.py"),
+    ("genara", "formatdata.py"),
+    ("genara", "benchmark.py"),
+    ("mageXML", "magexml.py"),
+    ("donut_utils", "inferencing.py"),
+    ("donut_utils", "page_pipeline.py"),
+    ("donut_utils", "cer.py"),
+    ("donut_utils", "CER_calc.py"),
+    ("donut_utils", "benchmark_backends.py"),
+]
+
+
+def slowest_imports(stderr: str, top: int) -> list:
+    """
+    top level imports with the largest cumulative time, from the output of python -X importtime
+    """
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        ## nested imports are indented, their time is already in their parent's cumulative time
+        if len(name) - len(name.lstrip()) == 1:
+            imports.append((name.strip(), int(cumulative) / 1000))
+    imports.sort(key=lambda i: -i[1])
+    return [{"module": name, "cumulative_ms": ms} for name, ms in imports[:top]]
+
+
+def measure(folder: str, script: str, repeats: int, top: int) -> dict:
+    cwd = os.path.join(ROOT, folder)
+    command = [sys.executable, script, "--help"]
+    ## the shared modules at the root are found through PYTHONPATH, see README.md
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        done = subprocess.run(command, cwd=cwd, env=env, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        if done.returncode != 0:
+            error = done.stderr.strip().splitlines()
+            return {"script": f"{folder}/{script}", "error": error[-1] if error else f"exit code {done.returncode}"}
+
+    done = subprocess.run([sys.executable, "-X", "importtime"] + command[1:], cwd=cwd, env=env, capture_output=True, text=True)
+    return {
+        "script": f"{folder}/{script}",
+        "median_ms": 1000 * statistics.median(times),
+        "min_ms": 1000 * min(times),
+        "slowest_imports": slowest_imports(done.stderr, top),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="measure the startup time of the command line tools")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5) ## number of slowest imports listed per script
+    parser.add_argument("--save_path", type=str, default=None) ## json report
+    args = parser.parse_args()
+
+    ## a bare interpreter, the floor every script pays
+    baseline = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"])
+        baseline.append(time.perf_counter() - start)
+    report = {"python_ms": 1000 * statistics.median(baseline), "scripts": []}
+    print(f"{'python':<36} {report['python_ms']:8.0f} ms")
+
+    for folder, script in ENTRY_POINTS:
+        result = measure(folder, script, args.repeats, args.top)
+        report["scripts"].append(result)
+        if "error" in result:
+            print(f"{result['script']:<36} failed: {result['error']}")
+            continue
+        slowest = ", ".join(f"{i['module']} {i['cumulative_ms']:.0f}" for i in result["slowest_imports"][:3])
+        print(f"{result['script']:<36} {result['median_ms']:8.0f} ms  ({slowest})")
+
+    if args.save_path:
+        with open(args.save_path, "w") as f:
+            json.dump(report, f, indent=2)
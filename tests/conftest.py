@@ -0,0 +1,29 @@
+import json
+import os
+import sys
+
+import pytest
+
+## the tools are scripts run from their own folder, their modules import each other by bare name
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for folder in ("", "genara", "donut_utils"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+
+@pytest.fixture
+def write_metadata(tmp_path):
+    """
+    write(split, {file_name: text}) writes a split folder's metadata.jsonl in the Donut format and returns its lines
+    """
+
+    def write(split, texts):
+        folder = tmp_path / split
+        folder.mkdir(exist_ok=True)
+        lines = [
+            json.dumps({"file_name": f, "ground_truth": json.dumps({"gt_parse": {"text_sequence": t}})}) + "\n"
+            for f, t in texts.items()
+        ]
+        (folder / "metadata.jsonl").write_text("".join(lines))
+        return lines
+
+    return write
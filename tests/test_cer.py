@@ -0,0 +1,29 @@
+import random
+
+from cer import edit_distance
+
+
+def dp_distance(a, b):
+    row = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        previous, row[0] = row[0], i
+        for j, cb in enumerate(b, 1):
+            previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (ca != cb))
+    return row[-1]
+
+
+def test_edit_distance_matches_dp():
+    rng = random.Random(0)
+    for _ in range(500):
+        ## a small alphabet gives many matches, long strings cross the 64 bit word size of the bit vectors
+        a = "".join(rng.choice("abcä ") for _ in range(rng.randint(0, 150)))
+        b = "".join(rng.choice("abcä ") for _ in range(rng.randint(0, 150)))
+        assert edit_distance(a, b) == dp_distance(a, b)
+
+
+def test_edit_distance_edge_cases():
+    assert edit_distance("", "") == 0
+    assert edit_distance("", "abc") == 3
+    assert edit_distance("kitten", "sitting") == 3
+    assert edit_distance("abc", "abc") == 0
+
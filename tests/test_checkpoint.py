@@ -0,0 +1,37 @@
+from checkpoint import Checkpoint
+
+
+def test_out_of_order_batches_leave_gaps(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), 7, 0, 100)
+    checkpoint.add(20, 30, {})
+    checkpoint.add(0, 10, {})
+    checkpoint.add(50, 60, {})
+    checkpoint.add(10, 20, {})
+
+    assert checkpoint.completed == [(0, 30), (50, 60)]
+    assert checkpoint.pending() == [(30, 50), (60, 100)]
+    assert checkpoint.completed_count() == 40
+
+
+def test_resume_restores_shards(tmp_path):
+    kept, cut, stray = tmp_path / "kept.jsonl", tmp_path / "cut.jsonl", tmp_path / "stray.jsonl"
+    kept.write_bytes(b"0\n1\n")
+    cut.write_bytes(b"2\n")
+
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), 7, 0, 10)
+    checkpoint.add(0, 3, {str(kept): 4, str(cut): 2})
+    checkpoint.save()
+
+    ## rows of batches that finished after the last save, and a shard only they wrote to
+    with open(cut, "ab") as f:
+        f.write(b"5\n")
+    stray.write_bytes(b"6\n")
+
+    resumed = Checkpoint.load(str(tmp_path / "checkpoint.json"))
+    assert (resumed.seed, resumed.start, resumed.end) == (7, 0, 10)
+    assert resumed.pending() == [(3, 10)]
+
+    resumed.restore_shards([str(kept), str(cut), str(stray)])
+    assert kept.read_bytes() == b"0\n1\n"
+    assert cut.read_bytes() == b"2\n"
+    assert not stray.exists()
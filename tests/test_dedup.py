@@ -0,0 +1,43 @@
+import json
+
+import numpy as np
+
+from dedup import duplicate_groups, load_samples, normalize_text, rewrite_metadata, text_hash
+
+
+def test_normalize_text():
+    assert normalize_text("  Hello\tWORLD \n") == "hello world"
+    ## compatibility forms (ligatures, full width letters) fold to their plain letters
+    assert normalize_text("ﬁne Ｆine") == "fine fine"
+    assert text_hash("Straße") == text_hash("STRASSE")
+    assert text_hash("a b") != text_hash("ab")
+
+
+def test_duplicate_groups_modes():
+    rng = np.random.default_rng(0)
+    h, d, other_h, other_d = (int(x) for x in rng.integers(0, 2 ** 63, 4, dtype=np.int64))
+    phashes = np.array([h, h ^ 0b101, other_h, h ^ (1 << 40), h ^ 0xFFFF], dtype=np.uint64)
+    dhashes = np.array([d, d ^ 0b11, other_d, d, d], dtype=np.uint64)
+    ## 0 and 1 are a re-scan, 3 the same image with another text, 4 too far off, 2 unrelated with 0's text
+    texts = np.array([text_hash(t) for t in ["a line", "A  line", "a line", "other", "a line"]], dtype=np.uint64)
+
+    assert duplicate_groups(phashes, dhashes, texts, "both").tolist() == [0, 0, 2, 3, 4]
+    assert duplicate_groups(phashes, dhashes, texts, "image").tolist() == [0, 0, 2, 0, 4]
+    assert duplicate_groups(phashes, dhashes, texts, "text").tolist() == [0, 0, 0, 3, 0]
+    assert duplicate_groups(phashes, dhashes, texts, "either").tolist() == [0, 0, 0, 0, 0]
+
+
+def test_rewrite_metadata_keeps_original(tmp_path, write_metadata):
+    lines = write_metadata("train", {"a.jpg": "x", "b.jpg": "x", "c.jpg": "y"})
+    samples = load_samples(str(tmp_path))
+    groups = np.array([0, 0, 2])
+    path = tmp_path / "train" / "metadata.jsonl"
+
+    rewrite_metadata(str(tmp_path), samples, groups, "drop")
+    assert path.read_text() == lines[0] + lines[2]
+    assert (tmp_path / "train" / "metadata.jsonl.orig").read_text() == "".join(lines)
+
+    ## a second rewrite never overwrites the backup of the original
+    rewrite_metadata(str(tmp_path), samples, groups, "weight")
+    assert [json.loads(line)["weight"] for line in path.read_text().splitlines()] == [0.5, 0.5, 1.0]
+    assert (tmp_path / "train" / "metadata.jsonl.orig").read_text() == "".join(lines)
@@ -0,0 +1,43 @@
+import io
+
+import pytest
+from PIL import Image
+
+from inferencing import open_reduced
+
+
+def encode(size, format):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (200, 180, 160)).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("format", ["JPEG", "PNG"])
+@pytest.mark.parametrize("size, min_side", [((4000, 3000), 960), ((2000, 1000), 960), ((1919, 2400), 960), ((900, 600), 960)])
+def test_open_reduced_never_below_min_side(format, size, min_side):
+    image = open_reduced(encode(size, format), min_side)
+
+    if min(size) <= min_side:
+        assert image.size == size
+    else:
+        ## no smaller than prepare_input resizes to, and never more than twice as large as needed
+        assert min(image.size) >= min_side
+        assert min(image.size) < 2 * min_side
+        ## the aspect ratio is kept up to rounding of the reduced sides
+        assert abs(image.width / image.height - size[0] / size[1]) < 0.01
+
+
+def test_reduced_and_full_decode_do_not_share_cache_entries(tmp_path):
+    from inferencing import cache_model_id
+    from prediction_cache import PredictionCache
+
+    path = str(tmp_path / "cache.sqlite")
+    data = encode((2000, 1500), "JPEG")
+    full = PredictionCache(path, cache_model_id("naver-clova-ix/donut-base", "torch"), "<s_task>")
+    reduced = PredictionCache(path, cache_model_id("naver-clova-ix/donut-base", "torch", 960), "<s_task>")
+
+    reduced.put(reduced.key(data), {"text_sequence": "from the reduced decode"})
+    assert full.get(full.key(data)) is None
+    full.put(full.key(data), {"text_sequence": "from the full decode"})
+    assert reduced.get(reduced.key(data)) == {"text_sequence": "from the reduced decode"}
+    assert full.get(full.key(data)) == {"text_sequence": "from the full decode"}
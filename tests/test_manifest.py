@@ -0,0 +1,32 @@
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from manifest import COLUMNS, ManifestWriter, join_predictions, read_manifest
+
+
+def test_write_read_join(tmp_path):
+    dataset_path, predictions_path = str(tmp_path / "dataset.parquet"), str(tmp_path / "run" / "predictions.parquet")
+    ## a row group of 2, the last one only written on close
+    with ManifestWriter(dataset_path, row_group_size=2) as manifest:
+        for i, split in enumerate(["train", "test", "test"]):
+            manifest.write(file_name=f"p_{i}.jpg", shard=split, split=split, source="p.jpg", index=i,
+                           coords=[[0, 10 * i], [100.0, 10 * i + 9]], ground_truth=f'line "{i}"')
+    with ManifestWriter(predictions_path) as manifest:
+        manifest.write(file_name="p_2.jpg", prediction="line 2", inference_ms=12.5)
+        manifest.write(file_name="p_1.jpg", prediction="line 1", inference_ms=8.0)
+
+    dataset = read_manifest(dataset_path)
+    assert dataset.column_names == [name for name, _ in COLUMNS]
+    assert dataset.num_rows == 3
+    assert dataset.column("bottom").to_pylist() == [9, 19, 29]
+    assert dataset.column("ground_truth").to_pylist()[1] == 'line "1"'
+
+    test = read_manifest(dataset_path, columns=["file_name"], filters=[("split", "=", "test")])
+    assert test.column("file_name").to_pylist() == ["p_1.jpg", "p_2.jpg"]
+
+    joined = join_predictions(dataset, read_manifest(predictions_path)).sort_by("file_name").to_pylist()
+    assert [(r["file_name"], r["ground_truth"], r["prediction"], r["inference_ms"]) for r in joined] == [
+        ("p_1.jpg", 'line "1"', "line 1", 8.0),
+        ("p_2.jpg", 'line "2"', "line 2", 12.5),
+    ]
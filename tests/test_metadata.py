@@ -0,0 +1,16 @@
+import pytest
+
+import cer
+import dedup
+
+
+@pytest.mark.parametrize("load, expected", [
+    (cer.load_references, lambda text, lines: {"a_0.jpg": ("train", text)}),
+    (dedup.load_samples, lambda text, lines: [("train", "a_0.jpg", text, lines[0])]),
+])
+def test_readers_keep_quotes_and_backslashes(tmp_path, write_metadata, load, expected):
+    ## mageXML and genara both write the ground truth with json.dumps, any transcription reads back unchanged
+    text = 'he said "no" \\ C:\\scans'
+    lines = write_metadata("train", {"a_0.jpg": text})
+
+    assert load(str(tmp_path)) == expected(text, lines)
@@ -0,0 +1,35 @@
+import os
+
+from metrics import PREFIX, Metrics
+
+
+def test_render_prometheus_text():
+    metrics = Metrics("genara", total=10)
+    metrics.done(3)
+    metrics.error(ValueError("bad"))
+    metrics.error("Timeout", stage='read "x"')
+    metrics.set("queue_depth", 4)
+    metrics.set("eta_seconds", float("nan"))
+
+    lines = metrics.render().splitlines()
+    assert f"# TYPE {PREFIX}_items_total counter" in lines
+    assert f'{PREFIX}_items_total{{job="genara"}} 3.0' in lines
+    assert f'{PREFIX}_errors_total{{job="genara",type="ValueError"}} 1.0' in lines
+    assert f'{PREFIX}_errors_total{{job="genara",stage="read \\"x\\"",type="Timeout"}} 1.0' in lines
+    assert f"# TYPE {PREFIX}_queue_depth gauge" in lines
+    assert f'{PREFIX}_eta_seconds{{job="genara"}} NaN' in lines
+    ## one TYPE line per metric, followed by its samples
+    assert sum(line.startswith(f"# TYPE {PREFIX}_errors_total ") for line in lines) == 1
+
+
+def test_file_export_without_pid_labels(tmp_path):
+    path = str(tmp_path / "genara.prom")
+    with Metrics("genara", path=path, interval=60) as metrics:
+        metrics.done()
+    with open(path) as f:
+        text = f.read()
+
+    assert f'{PREFIX}_items_total{{job="genara"}} 1.0' in text
+    assert 'role="main"' in text and 'role="workers"' in text
+    assert "pid=" not in text
+    assert not os.path.exists(path + ".tmp")
@@ -0,0 +1,16 @@
+import numpy as np
+
+from seeding import FONT, RENDER, TEXT, sample_seed, sample_seeds
+
+
+def test_sample_seeds_matches_sample_seed():
+    indices = np.array([0, 1, 2, 1000, 2 ** 31, 2 ** 40 + 7])
+    for run_seed in (0, 1, 2 ** 63 - 1, 0x123456789abcdef):
+        for stream in (TEXT, FONT, RENDER):
+            vectorized = sample_seeds(run_seed, indices, stream)
+            assert vectorized.dtype == np.uint64
+            assert [int(z) for z in vectorized] == [sample_seed(run_seed, int(i), stream) for i in indices]
+
+
+def test_streams_are_independent():
+    assert len({sample_seed(42, 7, stream) for stream in (TEXT, FONT, RENDER)}) == 3
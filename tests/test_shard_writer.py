@@ -0,0 +1,26 @@
+import json
+import os
+
+import shard_writer
+from shard_writer import finalize, folders, metadata_row, write_shard
+
+
+def test_finalize_merges_shards_in_order(tmp_path, monkeypatch):
+    output_dir = str(tmp_path)
+    shard_writer.make_split_dirs(output_dir)
+
+    ## two runs (a resumed one included) writing interleaved indices, index 4 written by both
+    monkeypatch.setattr(shard_writer, "shard_prefix", "host-run1")
+    write_shard(output_dir, [(0, metadata_row(f"{i}.jpg", f"text {i}")) for i in (0, 4, 8)])
+    monkeypatch.setattr(shard_writer, "shard_prefix", "host-run2")
+    write_shard(output_dir, [(0, metadata_row(f"{i}.jpg", f'"quoted" {i}')) for i in (2, 4, 6, 10)])
+
+    finalize(output_dir)
+
+    with open(os.path.join(output_dir, folders[0], "metadata.jsonl"), encoding="utf8") as f:
+        rows = [json.loads(line) for line in f]
+    assert [row["file_name"] for row in rows] == [f"{i}.jpg" for i in (0, 2, 4, 6, 8, 10)]
+    assert json.loads(rows[1]["ground_truth"])["gt_parse"]["text_sequence"] == '"quoted" 2'
+    for folder in folders[1:]:
+        with open(os.path.join(output_dir, folder, "metadata.jsonl")) as f:
+            assert f.read() == ""